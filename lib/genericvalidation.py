@@ -1,7 +1,14 @@
 from sklearn.metrics import pairwise_distances
+import os
+import hashlib
+import numpy as np
+from scipy import sparse
 import pandas as pd
 import geopandas as gpd
+import pyproj
+import shapely
 import lib.helpers as helpers
+import lib.models as models
 
 
 def zone_distances(zones):
@@ -35,6 +42,139 @@ def distance_quantiles(zone_dist):
     return qgrps, bins
 
 
+def distance_group_codes(quantile_groups):
+    """
+    Position of the distance group of every pair of zones in the order of `quantile_groups.groups`,
+    as used by validation.DistanceMetrics.distance_sums.
+
+    :param quantile_groups:
+    pd.SeriesGroupBy from distance_quantiles.
+    """
+    return quantile_groups.ngroup().values.astype(np.int64)
+
+
+class DistanceBins:
+    """
+    The distance group of every pair of zones as one uint8 code per pair origin * n_zones + destination,
+    with the group edges, in place of the stacked zone distances and their SeriesGroupBy.
+    The groups are the quantiles of the centroid distances, right-closed with the first one including
+    its lower edge like pd.qcut. Computed once per zoning, see `cached`.
+
+    :param codes:
+    Group of every pair of zones.
+
+    :param edges:
+    n_groups + 1 strictly increasing edges of the groups in km.
+
+    :param centroids:
+    (n_zones, 2) array of zone centroids in km, for the distances of single pairs.
+    """
+
+    def __init__(self, codes=None, edges=None, centroids=None):
+        if codes is None or edges is None or centroids is None:
+            raise Exception("codes, edges and centroids must be set")
+        self.codes = codes
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.centroids = centroids
+        # The groups as labelled by pd.qcut
+        self.labels = pd.cut(np.array([]), bins=self.edges, include_lowest=True, precision=3).categories
+
+    @property
+    def n_groups(self):
+        return self.edges.shape[0] - 1
+
+    @property
+    def n_zones(self):
+        return self.centroids.shape[0]
+
+    def distances(self, keys):
+        """Centroid distance in km of the pairs origin * n_zones + destination."""
+        origins, destinations = np.divmod(np.asarray(keys, dtype=np.int64), self.n_zones)
+        return np.hypot(*(self.centroids[origins] - self.centroids[destinations]).T)
+
+    @classmethod
+    def compute(cls, zones, n_groups=100, sample=None, seed=0, chunk_pairs=2 ** 22):
+        """
+        :param zones:
+        GeoDataFrame [zone, geometry] in a CRS of unit metre.
+
+        :param sample:
+        Number of random pairs of zones to estimate the quantiles from. None uses all pairs,
+        which gives the groups of distance_quantiles.
+
+        Quantiles that fall on the same distance are merged like pd.qcut(duplicates='drop'),
+        so clustered distances give fewer than `n_groups` groups.
+        """
+        for ax in zones.crs.axis_info:
+            assert ax.unit_name == 'metre'
+        if n_groups > 256:
+            raise Exception("n_groups must be at most 256")
+        print("Calculating distance groups between zones...")
+        centroids = np.column_stack([zones.geometry.centroid.x.values, zones.geometry.centroid.y.values])
+        n_zones = centroids.shape[0]
+        step = max(chunk_pairs // n_zones, 1)
+
+        def distances(first, last):
+            # Distances from a block of origins, as from zone_distances
+            block = pairwise_distances(centroids[first:last], centroids) / 1000
+            block[np.arange(last - first), np.arange(first, last)] = 0
+            return block.ravel()
+
+        quantiles = np.linspace(0, 1, n_groups + 1)
+        if sample is None:
+            all_distances = np.concatenate([distances(first, min(first + step, n_zones))
+                                            for first in range(0, n_zones, step)])
+            edges = np.quantile(all_distances, quantiles)
+            del all_distances
+        else:
+            pairs = np.random.default_rng(seed).integers(0, n_zones * n_zones, sample)
+            origins, destinations = np.divmod(pairs, n_zones)
+            edges = np.quantile(np.hypot(*(centroids[origins] - centroids[destinations]).T) / 1000, quantiles)
+            # The outer edges are the extremes of all pairs, so that every pair falls in a group
+            edges[0] = 0.0
+            edges[-1] = max(distances(first, min(first + step, n_zones)).max() for first in range(0, n_zones, step))
+
+        edges = np.unique(edges)
+        n_groups = edges.shape[0] - 1
+        codes = np.empty(n_zones * n_zones, dtype=np.uint8)
+        for first in range(0, n_zones, step):
+            last = min(first + step, n_zones)
+            groups = np.searchsorted(edges, distances(first, last), side='left') - 1
+            codes[first * n_zones:last * n_zones] = np.clip(groups, 0, n_groups - 1)
+        return cls(codes=codes, edges=edges, centroids=centroids / 1000)
+
+    @classmethod
+    def cached(cls, zones, cache_dir, n_groups=100, sample=None, seed=0):
+        """
+        As compute, but kept in `cache_dir` under a hash of the zone geometries, and memory-mapped
+        from there so that every process shares the codes.
+        """
+        key = hashlib.sha1()
+        for wkb in shapely.to_wkb(np.asarray(zones.geometry.values)):
+            key.update(wkb)
+        key.update(repr((zones.crs.to_string(), n_groups, sample, seed)).encode())
+        path = os.path.join(cache_dir, 'distance_bins_' + key.hexdigest())
+        if not os.path.exists(os.path.join(path, 'edges.npy')):
+            cls.compute(zones, n_groups=n_groups, sample=sample, seed=seed).save(path)
+        return cls.load(path)
+
+    def save(self, path):
+        """
+        Writes the codes, centroids and edges to the directory `path`, the edges last.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in ('codes', 'centroids', 'edges'):
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        return cls(
+            codes=np.load(os.path.join(path, 'codes.npy'), mmap_mode=mmap_mode),
+            edges=np.load(os.path.join(path, 'edges.npy')),
+            centroids=np.load(os.path.join(path, 'centroids.npy')),
+        )
+
+
 def crs_convert_visits(visits, zones):
     print("Convering visits to zone CRS")
     visits = gpd.GeoDataFrame(
@@ -45,12 +185,124 @@ def crs_convert_visits(visits, zones):
     return visits.to_crs(zones.crs)
 
 
-def align_visits_to_zones(visits, zones):
+class ZoneIndex:
+    """
+    Point-to-zone lookup that is built once for a set of zones and reused for every alignment.
+    A raster grid over the zones stores the zone of every cell that lies inside a single zone,
+    so most points are resolved with one array lookup. Only points in cells that cross a zone border
+    are tested exactly, with the spatial index (an STRtree of prepared geometries) of the zones.
+
+    :param zones:
+    GeoDataFrame [zone, geometry] in a CRS of unit metre.
+
+    :param cell_m:
+    Size of the raster cells in metres. Defaults to the size that gives about `max_cells` cells.
+
+    :param max_cells:
+    Upper bound of the raster size, 0 skips the raster and tests every point exactly (for one-off lookups).
+    """
+
+    def __init__(self, zones=None, cell_m=None, max_cells=2 ** 20):
+        if zones is None:
+            raise Exception("zones must be set")
+        self.zones = zones
+        self.geometry = np.asarray(zones.geometry.values)
+        shapely.prepare(self.geometry)
+        self.sindex = zones.sindex
+        self.transformer = pyproj.Transformer.from_crs("EPSG:4326", zones.crs, always_xy=True)
+
+        x0, y0, x1, y1 = zones.total_bounds
+        if max_cells == 0:
+            self.cell_m, self.origin, self.shape = 1.0, (x0, y0), (0, 0)
+            self.grid = np.zeros(0, dtype=np.int64)
+            return
+        if cell_m is None:
+            cell_m = max(np.sqrt((x1 - x0) * (y1 - y0) / max_cells), 1.0)
+        self.cell_m = cell_m
+        self.origin = (x0, y0)
+        # One more cell on each axis so that points on the upper bounds fall in the grid
+        self.shape = (int((y1 - y0) // cell_m) + 1, int((x1 - x0) // cell_m) + 1)
+
+        rows, cols = np.divmod(np.arange(self.shape[0] * self.shape[1]), self.shape[1])
+        cells = shapely.box(x0 + cols * cell_m, y0 + rows * cell_m, x0 + (cols + 1) * cell_m, y0 + (rows + 1) * cell_m)
+        cell, zone = self.sindex.query(cells, predicate='intersects')
+        hits = np.bincount(cell, minlength=cells.shape[0])
+        # -1 for cells outside all zones, -2 for cells that need the exact test
+        self.grid = np.where(hits == 0, -1, -2).astype(np.int64)
+        single = hits[cell] == 1
+        covered = shapely.covers(self.geometry[zone[single]], cells[cell[single]])
+        self.grid[cell[single][covered]] = zone[single][covered]
+
+    def __len__(self):
+        return self.zones.shape[0]
+
+    def lookup(self, x, y):
+        """
+        Position in `zones` of the zone that contains each point, -1 for points outside all zones.
+        A point on the border of several zones gets the first of them.
+
+        :param x, y:
+        Arrays of coordinates in the CRS of the zones.
+        """
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        cols = np.floor((x - self.origin[0]) / self.cell_m)
+        rows = np.floor((y - self.origin[1]) / self.cell_m)
+        inside = (cols >= 0) & (cols < self.shape[1]) & (rows >= 0) & (rows < self.shape[0])
+        codes = np.full(x.shape[0], -1 if self.grid.size > 0 else -2, dtype=np.int64)
+        codes[inside] = self.grid[rows[inside].astype(np.int64) * self.shape[1] + cols[inside].astype(np.int64)]
+
+        exact = np.flatnonzero(codes == -2)
+        codes[exact] = -1
+        if exact.size > 0:
+            point, zone = self.sindex.query(shapely.points(x[exact], y[exact]), predicate='intersects')
+            if point.size > 0:
+                # Keep the first zone of every point
+                order = np.lexsort((zone, point))
+                point, zone = point[order], zone[order]
+                first = np.concatenate([[True], point[1:] != point[:-1]])
+                codes[exact[point[first]]] = zone[first]
+        return codes
+
+    def lookup_lonlat(self, latitudes, longitudes):
+        """
+        As lookup, for arrays of WGS84 coordinates.
+        """
+        x, y = self.transformer.transform(np.asarray(longitudes, dtype=np.float64),
+                                          np.asarray(latitudes, dtype=np.float64))
+        return self.lookup(x, y)
+
+
+def zone_codes(latitudes, longitudes, zones):
+    """
+    Position in `zones` of the zone that contains each point, -1 for points outside all zones.
+
+    :param latitudes, longitudes:
+    Arrays of WGS84 coordinates.
+
+    :param zones:
+    A ZoneIndex, or a GeoDataFrame [zone, geometry] to build one for this call.
+    """
+    if not isinstance(zones, ZoneIndex):
+        zones = ZoneIndex(zones, max_cells=0)
+    return zones.lookup_lonlat(latitudes, longitudes)
+
+
+def zone_join(visits, zones, zone_index):
+    """
+    Inner join of GeoDataFrame `visits` (in the CRS of the zones) with the zone that contains each of them.
+    """
+    codes = zone_index.lookup(visits.geometry.x.values, visits.geometry.y.values)
+    return visits[codes >= 0].assign(zone=zones.zone.values[codes[codes >= 0]])
+
+
+def align_visits_to_zones(visits, zones, zone_index=None):
+    if zone_index is None:
+        zone_index = ZoneIndex(zones, max_cells=0)
     print("Aligning region-visits to zones...")
     regional_visits = visits[visits.kind == 'region']
     n_regional_visits_before = regional_visits.shape[0]
     user_regions = regional_visits.groupby(['userid', 'region']).head(1)
-    user_zones = gpd.sjoin(user_regions, zones, op='intersects')[['region', 'zone']]
+    user_zones = zone_join(user_regions, zones, zone_index)[['region', 'zone']]
     regional_visits = user_zones.merge(regional_visits, on=['userid', 'region'])
     print("removed", n_regional_visits_before - regional_visits.shape[0], "region-visits due to missing zone geom")
 
@@ -58,7 +310,7 @@ def align_visits_to_zones(visits, zones):
     point_visits = visits[visits.kind == 'point']
     if point_visits.shape[0] > 0:
         n_point_visits_before = point_visits.shape[0]
-        point_visits = gpd.sjoin(point_visits, zones, op='intersects')
+        point_visits = zone_join(point_visits, zones, zone_index)
         print("removed", n_point_visits_before - point_visits.shape[0], "point-visits due to missing zone geom")
     else:
         point_visits = point_visits.assign(zone='0')
@@ -68,6 +320,9 @@ def align_visits_to_zones(visits, zones):
     # Special handling of created at in order to have baseline and baseline 24h time threshold.
     if 'createdat' in visits:
         columns.append('createdat')
+    # User weights of the fused modes, see aligned_visits_to_odm
+    if 'weight' in visits:
+        columns.append('weight')
 
     visits = pd.concat([
         regional_visits[columns],
@@ -82,12 +337,14 @@ def align_visits_to_zones(visits, zones):
     return visits
 
 
-def align_raw_visits_to_zones(visits, zones):
+def align_raw_visits_to_zones(visits, zones, zone_index=None):
+    if zone_index is None:
+        zone_index = ZoneIndex(zones, max_cells=0)
     print("Aligning visits to zones...")
     regional_visits = visits.copy()
     n_regional_visits_before = regional_visits.shape[0]
     user_regions = regional_visits.groupby(['userid', 'region']).head(1)
-    user_zones = gpd.sjoin(user_regions, zones, op='intersects')[['region', 'zone']]
+    user_zones = zone_join(user_regions, zones, zone_index)[['region', 'zone']]
     regional_visits = user_zones.merge(regional_visits, on=['userid', 'region'])
     print("removed", n_regional_visits_before - regional_visits.shape[0], "region-visits due to missing zone geom")
 
@@ -102,48 +359,231 @@ def align_raw_visits_to_zones(visits, zones):
     return visits
 
 
-def aligned_visits_to_odm(visits, multiindex, timethreshold_hours=None):
+def aligned_visits_to_odm(visits, zones, timethreshold_hours=None):
+    """
+    :param zones:
+    GeoDataFrame [zone, geometry] or the zone names, by position.
+
+    :return:
+    Normalized SparseODM.
+    """
     print("Creating odm...")
-    gaps_columns = ['zone']
+    if not visits.index.is_monotonic_increasing:
+        visits = visits.sort_index(kind='mergesort')
+    zone_codes, zone_names = pd.factorize(visits.zone)
+    createdat = None
+    if timethreshold_hours is not None:
+        print("Applying timethreshold to gaps [{} hours]...".format(timethreshold_hours))
+        createdat = visits.createdat.values
+    origins, destinations, gaps = helpers.visit_gap_codes(visits.index.values, zone_codes, createdat,
+                                                          timethreshold_hours)
+    trip_weights = visits.weight.values[gaps] if "weight" in visits else None
+    odm = SparseODM.from_pairs(zone_names[origins], zone_names[destinations], trip_weights, zones)
+    return odm.normalize()
 
-    if "createdat" in visits:
-        gaps_columns.append("createdat")
 
-    if "weight" in visits:
-        gaps_columns.append("weight")
+class SparseODM:
+    """
+    Origin-destination matrix that only keeps the pairs of zones with a flow, so that its memory
+    grows with the non-zero flows instead of with zones². Pairs are keys origin * n_zones + destination
+    over the zones by position, sorted.
 
-    gaps = helpers.visit_gaps(visits[gaps_columns])
-    if timethreshold_hours is not None:
-        print("Applying timethreshold to gaps [{} hours]...".format(timethreshold_hours))
-        gaps = gaps.assign(duration=gaps.createdat_destination - gaps.createdat_origin)
-        gaps = gaps[gaps.duration < pd.Timedelta(timethreshold_hours, "hours")]
-
-    if "weight" not in visits:
-        gaps = gaps[['zone_origin', 'zone_destination']]
-        sparse_odm = gaps \
-            .groupby(['zone_origin', 'zone_destination']).size() \
-            .reindex(multiindex, fill_value=0.0)
-    else:
-        gaps = gaps[['zone_origin', 'zone_destination', 'weight']]
-        sparse_odm = gaps \
-            .groupby(['zone_origin', 'zone_destination'])['weight'].sum() \
-            .reindex(multiindex, fill_value=0.0)
-    sparse_odm = sparse_odm / sparse_odm.sum()
-    return sparse_odm
+    :param keys:
+    Key of every flow. Repeated keys are summed and zero flows are left out.
+
+    :param values:
+    Flow of every key, 1 each if None.
+
+    :param zones:
+    GeoDataFrame [zone, geometry] or the zone names, by position.
+    """
+
+    def __init__(self, keys=None, values=None, zones=None):
+        if keys is None or zones is None:
+            raise Exception("keys and zones must be set")
+        self.zones = pd.Index(zones.zone if isinstance(zones, pd.DataFrame) else zones)
+        keys = np.asarray(keys, dtype=np.int64)
+        values = np.ones(keys.shape[0]) if values is None else np.asarray(values, dtype=np.float64)
+        keys, inverse = np.unique(keys, return_inverse=True)
+        values = np.bincount(inverse.ravel(), weights=values, minlength=keys.shape[0])
+        self.keys = keys[values != 0]
+        self.values = values[values != 0]
+
+    @classmethod
+    def from_pairs(cls, origins, destinations, values=None, zones=None):
+        """
+        From the zone names of the origin and destination of every flow.
+        Flows from or to zones that are not in `zones` are left out.
+        """
+        names = pd.Index(zones.zone if isinstance(zones, pd.DataFrame) else zones)
+        origins, destinations = names.get_indexer(origins), names.get_indexer(destinations)
+        kept = (origins >= 0) & (destinations >= 0)
+        values = None if values is None else np.asarray(values)[kept]
+        return cls(origins[kept] * len(names) + destinations[kept], values, names)
+
+    @classmethod
+    def from_series(cls, odm, zones=None):
+        """From a pd.Series indexed by (origin zone, destination zone)."""
+        return cls.from_pairs(odm.index.get_level_values(0), odm.index.get_level_values(1), odm.values, zones)
+
+    @classmethod
+    def from_dense(cls, matrix, zones=None):
+        """From an (n_zones, n_zones) array with the origins as rows and zones by position."""
+        matrix = np.asarray(matrix, dtype=np.float64).ravel()
+        keys = np.flatnonzero(matrix)
+        return cls(keys, matrix[keys], zones)
+
+    @property
+    def n_zones(self):
+        return len(self.zones)
+
+    @property
+    def origins(self):
+        return self.keys // self.n_zones
+
+    @property
+    def destinations(self):
+        return self.keys % self.n_zones
+
+    def sum(self):
+        return self.values.sum()
+
+    def normalize(self):
+        return self / self.sum()
+
+    def mask(self, cond):
+        """
+        Copy without the flows of the pairs where `cond` is True, like pd.Series.mask with zeros.
+
+        :param cond:
+        Boolean array over all pairs origin * n_zones + destination, e.g. zone_distances(zones).values < 100,
+        or a function of the keys that returns one boolean per key.
+        """
+        kept = ~(cond(self.keys) if callable(cond) else np.asarray(cond)[self.keys])
+        return SparseODM(self.keys[kept], self.values[kept], self.zones)
+
+    def __add__(self, other):
+        if not self.zones.equals(other.zones):
+            raise Exception("ODMs must be over the same zones")
+        return SparseODM(np.concatenate([self.keys, other.keys]), np.concatenate([self.values, other.values]),
+                         self.zones)
+
+    def __mul__(self, factor):
+        return SparseODM(self.keys, self.values * factor, self.zones)
+
+    def __truediv__(self, divisor):
+        return SparseODM(self.keys, self.values / divisor, self.zones)
+
+    def distance_sums(self, codes, n_groups):
+        """
+        Sum of the flows in each distance group.
+
+        :param codes:
+        Distance group of every pair of zones, -1 for none, e.g. from distance_group_codes.
+        """
+        groups = np.asarray(codes)[self.keys]
+        grouped = groups >= 0
+        return np.bincount(groups[grouped], weights=self.values[grouped], minlength=n_groups)
 
+    def to_frame(self, title='odm'):
+        """
+        All pairs of zones as pd.DataFrame [ozone, dzone, title], zero flows included,
+        so that ODMs of the same zones can be merged row for row.
+        """
+        return self.to_series().rename(title).reset_index()
 
-def visits_to_odm(visits, zones, timethreshold_hours=None):
+    def to_series(self):
+        """Dense pd.Series over all pairs of zones, indexed by (origin zone, destination zone)."""
+        odm = np.zeros(self.n_zones * self.n_zones)
+        odm[self.keys] = self.values
+        return pd.Series(odm, index=pd.MultiIndex.from_product([self.zones, self.zones], names=['ozone', 'dzone']))
+
+
+def sparse_to_odm(keys, counts, zones):
+    """
+    Sums sparse trip counts into a normalized ODM.
+
+    :param keys:
+    origin * n_zones + destination, with zones by position in `zones`. May repeat.
+
+    :return:
+    SparseODM, as from aligned_visits_to_odm.
+    """
+    return SparseODM(keys, counts, zones).normalize()
+
+
+class UserODM:
+    """
+    The trips of every user between zones, kept as one sparse row per user, so the ODM
+    of any subset of users is a sum of rows instead of a new simulation.
+
+    :param matrix:
+    scipy.sparse.csr_matrix (n_users, n_zones * n_zones) of trip counts, with columns
+    origin * n_zones + destination and zones by position in `zones`.
+
+    :param userids:
+    Userid of every row.
+
+    :param zones:
+    GeoDataFrame [zone, geometry]
+    """
+
+    def __init__(self, matrix=None, userids=None, zones=None):
+        if matrix is None or userids is None or zones is None:
+            raise Exception("matrix, userids and zones must be set")
+        self.matrix = sparse.csr_matrix(matrix)
+        self.userids = pd.Index(userids)
+        self.zones = zones
+
+    @property
+    def n_users(self):
+        return self.matrix.shape[0]
+
+    def rows(self, userids):
+        """Rows of the users in `userids`, leaving out users without trips kept here."""
+        rows = self.userids.get_indexer(pd.Index(userids).unique())
+        return rows[rows >= 0]
+
+    def subset(self, userids):
+        rows = self.rows(userids)
+        return UserODM(matrix=self.matrix[rows], userids=self.userids[rows], zones=self.zones)
+
+    def odm(self, userids=None, weights=None):
+        """
+        Normalized ODM of the users in `userids` (all users if None).
+
+        :param weights:
+        Optional pd.Series of user weights indexed by userid. Users without a weight are left out.
+
+        :return:
+        SparseODM, as from aligned_visits_to_odm.
+        """
+        if weights is None:
+            user_weights = np.ones(self.n_users)
+        else:
+            user_weights = weights.reindex(self.userids).fillna(0).values.astype(np.float64)
+        if userids is not None:
+            selected = np.zeros(self.n_users, dtype=bool)
+            selected[self.rows(userids)] = True
+            user_weights = np.where(selected, user_weights, 0.0)
+        trips = self.matrix.tocoo()
+        return sparse_to_odm(trips.col, trips.data * user_weights[trips.row], self.zones)
+
+
+def visits_to_odm(visits, zones, timethreshold_hours=None, zone_index=None):
+    """
+    :param visits:
+    pd.DataFrame (userid*, kind, latitude, longitude, region, ...rest) or a models.VisitBatch
+
+    :param zone_index:
+    Optional ZoneIndex of `zones` to reuse between calls.
+    """
+    if isinstance(visits, models.VisitBatch):
+        visits = visits.to_frame()
     crs_visits = crs_convert_visits(visits, zones)
     if timethreshold_hours is not None:
-        aligned_visits = align_raw_visits_to_zones(crs_visits, zones)
+        aligned_visits = align_raw_visits_to_zones(crs_visits, zones, zone_index)
     else:
-        aligned_visits = align_visits_to_zones(crs_visits, zones)
-    odm = aligned_visits_to_odm(
-        aligned_visits,
-        pd.MultiIndex.from_product([
-            zones.zone.tolist(),
-            zones.zone.tolist(),
-        ]),
-        timethreshold_hours,
-    )
+        aligned_visits = align_visits_to_zones(crs_visits, zones, zone_index)
+    odm = aligned_visits_to_odm(aligned_visits, zones, timethreshold_hours)
     return odm
@@ -1,8 +1,10 @@
 import os
 import subprocess
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import lib.models as models
+import lib.simulation as simulation
 import lib.validation as validation
 import lib.helpers as helpers
 import lib.genericvalidation as genericvalidation
@@ -55,10 +57,10 @@ class RegionDataPrep:
         self.region = region
         self.bbox = None
         self.zones = None
+        self.zone_index = None
         self.gt_odm = None
-        self.distances = None
         self.trip_distances = None
-        self.distance_quantiles = None
+        self.distance_bins = None
         self.home_locations = None
         self.tweets_calibration = None
         self.tweets_validation = None
@@ -80,28 +82,27 @@ class RegionDataPrep:
 
         # assign values of zones and gt_odm
         self.zones = ground_truth.zones
-        self.gt_odm = ground_truth.odm
-        if self.region == 'sweden-national':
-            self.gt_odm[self.distances < 100] = 0
-            self.gt_odm = self.gt_odm / self.gt_odm.sum()
+        self.zone_index = genericvalidation.ZoneIndex(self.zones)
 
-        # calculate ODM-based distances
-        self.distances = genericvalidation.zone_distances(self.zones)
+        # distance quantile groups of the zone pairs, computed once per zoning
+        self.distance_bins = genericvalidation.DistanceBins.cached(self.zones, ROOT_dir + '/dbs/cache')
 
-        # calculate distance quantiles and get the bins for potential processing of the actual trip distances
-        self.distance_quantiles, bins = genericvalidation.distance_quantiles(self.distances)
+        self.gt_odm = ground_truth.odm
+        if self.region == 'sweden-national':
+            self.gt_odm = self.gt_odm.mask(lambda keys: self.distance_bins.distances(keys) < 100).normalize()
 
         # fetch the raw trip distances if ground_truth.trip_distances is not None
         if ground_truth.trip_distances is not None:
             self.trip_distances = ground_truth.trip_distances
-            self.trip_distances.loc[:, 'distance'] = pd.cut(self.trip_distances.distance, bins, right=True)
+            self.trip_distances.loc[:, 'distance'] = pd.cut(self.trip_distances.distance,
+                                                           self.distance_bins.edges, right=True)
             self.dms_true = pd.DataFrame(self.trip_distances.groupby('distance')['weight'].sum())
             self.dms_true.loc[:, 'weight'] = self.dms_true.loc[:, 'weight'] / sum(self.dms_true.loc[:, 'weight'])
             self.dms_true = self.dms_true.rename(columns={'weight': 'groundtruth_true_sum'})
 
         # Calculate zone-based distance distribution
         self.dms = validation.DistanceMetrics().compute(
-            self.distance_quantiles,
+            self.distance_bins,
             [self.gt_odm],
             ['groundtruth']
         )
@@ -145,28 +146,38 @@ class RegionDataPrep:
 
         # 2. Create benchmark odm from geotweets directly
         tweets.loc[:, 'kind'] = 'region'
-        self.bm_odm = genericvalidation.visits_to_odm(tweets, self.zones, timethreshold_hours=24)
+        self.bm_odm = genericvalidation.visits_to_odm(tweets, self.zones, timethreshold_hours=24,
+                                                        zone_index=self.zone_index)
         if self.region == 'sweden-national':
-            self.bm_odm[self.distances < 100] = 0
+            self.bm_odm = self.bm_odm.mask(lambda keys: self.distance_bins.distances(keys) < 100)
         # Save bm_odm in dbs for visualization purpose
         if type == 'calibration':
             benchmark_path = ROOT_dir + '/dbs/' + self.region + '/odm_benchmark_c.csv'
         else:
             benchmark_path = ROOT_dir + '/dbs/' + self.region + '/odm_benchmark_v.csv'
         if benchmark_save & (~os.path.exists(benchmark_path)):
-            bm_odm2save = self.bm_odm.copy()
-            bm_odm2save = bm_odm2save.reset_index()
-            bm_odm2save.columns = ['ozone', 'dzone', 'benchmark']
+            bm_odm2save = self.bm_odm.to_frame('benchmark')
             print('Saving bm_odm... \n', bm_odm2save.head())
             bm_odm2save.to_csv(benchmark_path)
 
         # Calculate zone-based distance distribution for benchmark
         self.dms_bm = validation.DistanceMetrics().compute(
-            self.distance_quantiles,
+            self.distance_bins,
             [self.bm_odm],
             ['benchmark']
         )
 
+    def evaluation_context(self, type='calibration'):
+        """
+        EvaluationContext of the calibration or validation tweets, to be built once they are loaded.
+        """
+        if type == 'calibration':
+            tweets = self.tweets_calibration
+        else:
+            tweets = self.tweets_validation
+        return EvaluationContext(region=self.region, tweets=tweets, zones=self.zones, zone_index=self.zone_index,
+                                 home_locations=self.home_locations, bbox=self.bbox)
+
     def kl_baseline_compute(self):
         # groundtruth, benchmark
         self.dms.loc[:, 'benchmark_sum'] = self.dms_bm.loc[:, 'benchmark_sum'].values
@@ -177,6 +188,108 @@ class RegionDataPrep:
         self.kl_baseline = validation.DistanceMetrics().kullback_leibler(self.dms, titles=['groundtruth', 'benchmark'])
 
 
+class EvaluationContext:
+    """
+    The part of visits2measure that does not depend on the model parameters, computed once for the tweets
+    of a region and split: the zone of every region of every user and the users living in the sampling bbox.
+    Its arrays are read-only, so that one context is shared by every evaluation of a search.
+    The distance groups of the zone pairs are shared the same way by RegionDataPrep.distance_bins.
+    Only exploration points, and regions located elsewhere than in the tweets (e.g. after downsampling),
+    are looked up in the zone index.
+    """
+
+    def __init__(self, region=None, tweets=None, zones=None, zone_index=None, home_locations=None, bbox=None):
+        if region is None or tweets is None or zones is None:
+            raise Exception("region, tweets and zones must be set")
+        self.zones = zones
+        self.zone_index = zone_index if zone_index is not None else genericvalidation.ZoneIndex(zones)
+
+        # Regions located at their first visit like in the simulation, sorted by user and region
+        regions = tweets[['region', 'latitude', 'longitude']].reset_index().drop_duplicates(['userid', 'region'])
+        self.users = pd.Index(regions.userid.unique())
+        region_users = self.users.get_indexer(regions.userid.values)
+        order = np.lexsort((regions.region.values, region_users))
+        self.region_users = region_users[order]
+        self.region_ids = regions.region.values[order].astype(np.int64)
+        self.region_latitudes = regions.latitude.values[order].astype(np.float64)
+        self.region_longitudes = regions.longitude.values[order].astype(np.float64)
+        self.region_zones = self.zone_index.lookup_lonlat(self.region_latitudes, self.region_longitudes)
+
+        # Users whose home is in the sampling bbox of the Swedish sub-regions, None means all users
+        self.sampled_users = None
+        if 'sweden-' in region:
+            self.sampled_users = gpd.sjoin(home_locations, bbox).index.unique()
+
+        for array in (self.region_users, self.region_ids, self.region_latitudes, self.region_longitudes,
+                      self.region_zones):
+            array.setflags(write=False)
+
+    def sampled(self, visits):
+        """Visits of the users living in the sampling bbox."""
+        if self.sampled_users is None:
+            return visits
+        return visits[visits.index.isin(self.sampled_users)]
+
+    def zone_codes(self, visits):
+        """
+        Zone code (position in `zones`, -1 if none) of every visit. Like align_visits_to_zones,
+        all visits to a region go to the zone of the first of them.
+
+        :param visits:
+        pd.DataFrame (userid*, kind, latitude, longitude, region, ...rest)
+
+        :return:
+        Zone codes, and position of the user of every visit.
+        """
+        codes = np.full(visits.shape[0], -1, dtype=np.int64)
+        users = self.users.get_indexer(visits.index)
+        unknown = users < 0
+        if unknown.any():
+            users[unknown] = len(self.users) + pd.factorize(visits.index[unknown])[0]
+        latitudes = visits.latitude.values.astype(np.float64)
+        longitudes = visits.longitude.values.astype(np.float64)
+
+        regional = np.flatnonzero(np.asarray(visits.kind == 'region'))
+        if regional.size > 0:
+            region_ids = visits.region.values[regional].astype(np.int64)
+            stride = max(region_ids.max(), self.region_ids.max(initial=0)) + 1
+            pairs, keys = pd.factorize(users[regional] * stride + region_ids)
+            first = regional[np.unique(pairs, return_index=True)[1]]
+            known_keys = self.region_users * stride + self.region_ids
+            rows = np.minimum(np.searchsorted(known_keys, keys), known_keys.shape[0] - 1)
+            # A region of the tweets, unless it is located elsewhere
+            known = (known_keys[rows] == keys) & (self.region_latitudes[rows] == latitudes[first]) & \
+                (self.region_longitudes[rows] == longitudes[first])
+            pair_zones = self.region_zones[rows]
+            pair_zones[~known] = self.zone_index.lookup_lonlat(latitudes[first[~known]], longitudes[first[~known]])
+            codes[regional] = pair_zones[pairs]
+
+        points = np.flatnonzero(np.asarray(visits.kind == 'point'))
+        if points.size > 0:
+            codes[points] = self.zone_index.lookup_lonlat(latitudes[points], longitudes[points])
+        return codes, users
+
+    def odm(self, visits):
+        """
+        Normalized ODM of the trips between consecutive visits of each user, as from
+        genericvalidation.visits_to_odm without a time threshold. Trips are weighted by the
+        `weight` column of the visits if present, like VisitsGeneration.odm_gen.
+
+        :param visits:
+        pd.DataFrame (userid*, day, timeslot, kind, latitude, longitude, region, ...rest) or a models.VisitBatch
+        """
+        if isinstance(visits, models.VisitBatch):
+            visits = visits.to_frame()
+        codes, users = self.zone_codes(visits)
+        order = np.lexsort((visits.timeslot.values, visits.day.values, users))
+        order = order[codes[order] >= 0]
+        codes, users = codes[order], users[order]
+        trips = users[1:] == users[:-1]
+        keys = codes[:-1][trips] * len(self.zones) + codes[1:][trips]
+        trip_weights = visits.weight.values[order][:-1][trips] if 'weight' in visits else None
+        return genericvalidation.sparse_to_odm(keys, trip_weights, self.zones)
+
+
 class VisitsGeneration:
     """
     VisitsGeneration takes region and its zones, odm, and distance groups as initiated.
@@ -185,27 +298,46 @@ class VisitsGeneration:
     """
 
     def __init__(self, region=None, bbox=None, zones=None, odm=None,
-                 distances=None, distance_quantiles=None, gt_dms=None):
+                 distance_bins=None, gt_dms=None, zone_index=None, context=None, top_k=None):
         self.region = region
+        # Truncation of the transition rows for the batch engines, None keeps them exact
+        self.top_k = top_k
+        self.context = context
         self.zones = zones
+        self.zone_index = zone_index
         self.odm = odm
-        self.distances = distances
-        self.distance_quantiles = distance_quantiles
+        self.distance_bins = distance_bins
         self.gt_dms = gt_dms
         self.bbox = bbox
 
-    def visits_gen(self, geotweets=None, p=None, gamma=None, beta=None, days=None, homelocations=None):
-        visit_factory = models.Sampler(
-            model=models.PreferentialReturn(
-                p=p,
-                gamma=gamma,
-                region_sampling=models.RegionTransitionZipf(beta=beta, zipfs=1.2)
-            ),
-            n_days=days,
-            daily_trips_sampling=models.WeightedDistribution()
-        )
-        # Calculate visits
-        visits = visit_factory.sample(geotweets)
+    def visits_gen(self, geotweets=None, p=None, gamma=None, beta=None, days=None, homelocations=None,
+                   engine='loop', executor=None):
+        """
+        Generates visits for the users in `geotweets`.
+        If a simulation.SimulationExecutor is given, its workers already hold the tweets
+        and `geotweets` is not used.
+
+        :param engine:
+        Engine of models.Sampler. The default 'loop' fits and simulates the users one by one.
+        'batch' and 'jit' are much faster, but rank regions with tied tweet counts by region id
+        and leave out users with a single region, so their visits differ from the loop's.
+        """
+        if executor is not None:
+            visits = executor.evaluate(p=p, gamma=gamma, beta=beta, days=days)
+        else:
+            visit_factory = models.Sampler(
+                model=models.PreferentialReturn(
+                    p=p,
+                    gamma=gamma,
+                    region_sampling=models.RegionTransitionZipf(beta=beta, zipfs=1.2)
+                ),
+                n_days=days,
+                daily_trips_sampling=models.WeightedDistribution(),
+                engine=engine,
+                top_k=self.top_k
+            )
+            # Calculate visits
+            visits = visit_factory.sample(geotweets)
 
         # Add weight if applicable
         if 'weight' in homelocations:
@@ -213,23 +345,165 @@ class VisitsGeneration:
                               left_index=True, right_index=True)
         return visits
 
+    def odm_gen(self, geotweets=None, p=None, gamma=None, beta=None, days=None, homelocations=None,
+                executor=None):
+        """
+        Generates the model ODM for the users in `geotweets` without collecting their visits:
+        the workers count the trips between zones and only the sparse counts are summed.
+        The executor must have been created with the zones; without one, a temporary executor is used.
+        Users are weighted by `homelocations.weight` if present.
+        """
+        weights = self.user_weights(homelocations)
+        if executor is not None:
+            return executor.evaluate_odm(p=p, gamma=gamma, beta=beta, days=days, weights=weights)
+        with simulation.SimulationExecutor(tweets=geotweets, zones=self.zones,
+                                           zone_index=self.zone_index, top_k=self.top_k) as executor:
+            return executor.evaluate_odm(p=p, gamma=gamma, beta=beta, days=days, weights=weights)
+
+    def odm_converge(self, geotweets=None, p=None, gamma=None, beta=None, homelocations=None, executor=None,
+                     block_days=20, max_days=260, tol=0.01):
+        """
+        Simulates blocks of `block_days` days and updates the model ODM after each block, until its
+        KL divergence changes by less than the fraction `tol` between two blocks or `max_days` have been
+        simulated. A block whose divergence is the 999 of kullback_leibler for empty bins, or not finite,
+        never counts as converged.
+        The executor must have been created with the zones; without one, a temporary executor is used.
+
+        :return:
+        dms, divergence measure and model ODM as from odm2measure, and the number of days simulated
+        """
+        weights = self.user_weights(homelocations)
+        checkpoints = list(range(block_days, max_days, block_days)) + [max_days]
+        own_executor = executor is None
+        if own_executor:
+            executor = simulation.SimulationExecutor(tweets=geotweets, zones=self.zones,
+                                                     zone_index=self.zone_index, top_k=self.top_k)
+        try:
+            previous = None
+            for days, model_odm in executor.iter_odm(p=p, gamma=gamma, beta=beta, checkpoints=checkpoints,
+                                                     weights=weights):
+                dms, divergence_measure, model_odm = self.odm2measure(model_odm)
+                if not np.isfinite(divergence_measure) or divergence_measure == 999:
+                    previous = None
+                    continue
+                if previous is not None and abs(divergence_measure - previous) < tol * previous:
+                    break
+                previous = divergence_measure
+        finally:
+            if own_executor:
+                executor.close()
+        print("Simulated", days, "days")
+        return dms, divergence_measure, model_odm, days
+
+    def odm_sweep(self, geotweets=None, p=None, gamma=None, beta=None, checkpoints=None, homelocations=None,
+                  executor=None, seed=None):
+        """
+        Simulates once up to the largest of `checkpoints` (in days) and measures the cumulative model ODM
+        at every checkpoint. With a seed, each checkpoint gives the same ODM as an independent run
+        of that many days.
+        The executor must have been created with the zones; without one, a temporary executor is used.
+
+        :return:
+        dict of days -> (dms, divergence measure, model ODM) as from odm2measure
+        """
+        weights = self.user_weights(homelocations)
+        own_executor = executor is None
+        if own_executor:
+            executor = simulation.SimulationExecutor(tweets=geotweets, zones=self.zones,
+                                                     zone_index=self.zone_index, top_k=self.top_k)
+        try:
+            model_odms = dict(executor.iter_odm(p=p, gamma=gamma, beta=beta, checkpoints=sorted(checkpoints),
+                                               seed=seed, weights=weights))
+        finally:
+            if own_executor:
+                executor.close()
+        return dict(zip(model_odms, self.odms2measure(list(model_odms.values()))))
+
+    def user_odm_gen(self, geotweets=None, p=None, gamma=None, beta=None, days=None, executor=None, seed=None):
+        """
+        Simulates the users in `geotweets` once and keeps the trips of every user apart,
+        for measuring subsets of users with subset2measure.
+        The executor must have been created with the zones; without one, a temporary executor is used.
+
+        :return:
+        genericvalidation.UserODM
+        """
+        if executor is not None:
+            return executor.evaluate_user_odm(p=p, gamma=gamma, beta=beta, days=days, seed=seed)
+        with simulation.SimulationExecutor(tweets=geotweets, zones=self.zones,
+                                           zone_index=self.zone_index, top_k=self.top_k) as executor:
+            return executor.evaluate_user_odm(p=p, gamma=gamma, beta=beta, days=days, seed=seed)
+
+    def subset2measure(self, user_odm=None, userids=None, homelocations=None):
+        """
+        Measures the model ODM of the users in `userids` (all users if None) from a UserODM,
+        weighted like odm_gen.
+
+        :return:
+        dms, divergence measure and model ODM as from odm2measure
+        """
+        model_odm = user_odm.odm(userids=userids, weights=self.user_weights(homelocations))
+        return self.odm2measure(model_odm)
+
+    def user_weights(self, homelocations=None):
+        """
+        Per-user weights for the ODM of the fused modes: `homelocations.weight` if present,
+        restricted to the users living in the sampling bbox for the Swedish sub-regions.
+        None means every user counts once.
+        """
+        weights = homelocations['weight'] if 'weight' in homelocations else None
+        if 'sweden-' in self.region:
+            if self.context is not None:
+                users_in_sampling = self.context.sampled_users
+            else:
+                users_in_sampling = gpd.sjoin(homelocations, self.bbox).index.unique()
+            if weights is None:
+                weights = pd.Series(1.0, index=users_in_sampling)
+            else:
+                weights = weights[weights.index.isin(users_in_sampling)]
+        return weights
+
     def visits2measure(self, visits=None, home_locations=None):
+        """
+        Measures the model ODM of `visits`. With an EvaluationContext, only the exploration points
+        are assigned to zones.
+        """
+        if self.context is not None:
+            n_visits_before = visits.shape[0]
+            visits = self.context.sampled(visits)
+            if 'sweden-' in self.region:
+                print("removed", n_visits_before - visits.shape[0], "visits due to sampling bbox")
+            return self.odm2measure(self.context.odm(visits))
         if 'sweden-' in self.region:
             n_visits_before = visits.shape[0]
             home_locations_in_sampling = gpd.sjoin(home_locations, self.bbox)
             visits = visits[visits.index.isin(home_locations_in_sampling.index)]
             print("removed", n_visits_before - visits.shape[0], "visits due to sampling bbox")
-        model_odm = genericvalidation.visits_to_odm(visits, self.zones)
+        model_odm = genericvalidation.visits_to_odm(visits, self.zones, zone_index=self.zone_index)
+        return self.odm2measure(model_odm)
+
+    def odm2measure(self, model_odm=None):
+        return self.odms2measure([model_odm])[0]
+
+    def odms2measure(self, model_odms=None):
+        """
+        Measures a stack of model ODMs (replicates, parameter sets, checkpoints...) as odm2measure,
+        with the distance distributions of all of them computed in one call.
+
+        :return:
+        List of (dms, divergence measure, model ODM), one per ODM
+        """
         if self.region == 'sweden-national':
-            model_odm[self.distances < 100] = 0
+            model_odms = [odm.mask(lambda keys: self.distance_bins.distances(keys) < 100) for odm in model_odms]
 
-        dms = validation.DistanceMetrics().compute(
-            self.distance_quantiles,
-            [model_odm],
-            ['model']
-        )
-        for var in ['groundtruth_sum', 'groundtruth_true_sum', 'benchmark_sum']:
-            if var in self.gt_dms.columns:
-                dms.loc[:, var] = self.gt_dms.loc[:, var].values
-        divergence_measure = validation.DistanceMetrics().kullback_leibler(dms, titles=['groundtruth', 'model'])
-        return dms, divergence_measure, model_odm
+        sums = validation.DistanceMetrics().distance_sums(self.distance_bins, model_odms)
+        groups = pd.Index(validation.DistanceMetrics().groups(self.distance_bins), name='distance')
+        measures = []
+        for model_odm, model_sums in zip(model_odms, sums):
+            dms = pd.DataFrame({'model_sum': model_sums}, index=groups)
+            for var in ['groundtruth_sum', 'groundtruth_true_sum', 'benchmark_sum']:
+                if var in self.gt_dms.columns:
+                    dms.loc[:, var] = self.gt_dms.loc[:, var].values
+            divergence_measure = validation.DistanceMetrics().kullback_leibler(dms, titles=['groundtruth', 'model'])
+            measures.append((dms, divergence_measure, model_odm))
+        return measures
@@ -184,6 +184,51 @@ def visit_gaps(visits):
     return visits.groupby('userid').apply(f).reset_index(level=1, drop=True)
 
 
+def visit_gap_codes(users, zones, createdat=None, timethreshold_hours=None):
+    """
+    Gaps between consecutive visits of each user like visit_gaps, in one pass over the arrays
+    of all users instead of a pass per user.
+
+    :param users:
+     User of every visit. The visits of a user must be contiguous and in chronological order.
+    :param zones:
+     Integer zone code of every visit.
+    :param createdat:
+     datetime64 array of the time of every visit, needed for timethreshold_hours.
+    :param timethreshold_hours:
+     Optional. Only the gaps shorter than this are kept.
+    :return:
+     Origin and destination zone codes of every gap, and the position of its origin visit.
+    """
+    users = np.asarray(users)
+    zones = np.asarray(zones)
+    same_user = users[1:] == users[:-1]
+    if timethreshold_hours is not None:
+        durations = createdat[1:] - createdat[:-1]
+        same_user &= durations < pd.Timedelta(timethreshold_hours, "hours").to_timedelta64()
+    gaps = np.flatnonzero(same_user)
+    return zones[gaps], zones[gaps + 1], gaps
+
+
+def user_slices(df):
+    """
+    Locates the rows of every user once, so that each user's data can be handed out
+    as a positional slice instead of a lookup in the full frame.
+
+    :param df:
+    DataFrame indexed by "userid" where the rows of a user are contiguous, e.g. sorted by userid.
+
+    :return:
+    List of (userid, start, stop) such that df.iloc[start:stop] are the rows of the user.
+    """
+    ids = df.index.values
+    if ids.shape[0] == 0:
+        return []
+    starts = np.flatnonzero(np.concatenate([[True], ids[1:] != ids[:-1]]))
+    stops = np.concatenate([starts[1:], [ids.shape[0]]])
+    return list(zip(ids[starts], starts, stops))
+
+
 geotweet_paths = {
     "sweden": os.getcwd() + "/dbs/sweden/geotweets.csv",
     "sweden_infered": os.getcwd() + "/dbs/sweden/geotweets_infered.csv",
@@ -1,9 +1,11 @@
 import pandas as pd
 import numpy as np
+from scipy import special
 from sklearn.metrics.pairwise import haversine_distances
 import lib.helpers as helpers
+import lib.simulation as simulation
 import multiprocessing as mp
-import random
+import itertools
 
 
 class PreferentialReturn:
@@ -25,6 +27,12 @@ class PreferentialReturn:
     Defaults to the true distribution observed from tweets.
     """
 
+    __slots__ = (
+        'p', 'gamma', 'region_sampling', 'direction_jump_size_sampling',
+        'region_ids', 'latitudes', 'longitudes', 'region_rows', 'max_region',
+        'exploration_prob', 's',
+    )
+
     def __init__(self, p=None, gamma=None, region_sampling=None, direction_jump_size_sampling=None):
         if p is None:
             raise Exception('p must be set')
@@ -34,7 +42,12 @@ class PreferentialReturn:
             raise Exception('gamma must be set')
         self.gamma = gamma
 
-        self.regions = None
+        # Fitted regions, sorted by region id
+        self.region_ids = None
+        self.latitudes = None
+        self.longitudes = None
+        self.region_rows = None
+        self.max_region = None
         self.exploration_prob = None
         self.s = None # number of distinct places
 
@@ -58,16 +71,17 @@ class PreferentialReturn:
         self.region_sampling.fit(tweets)
         self.direction_jump_size_sampling.fit(tweets)
 
-        self.regions = tweets.groupby('region').head(1).set_index('region')
+        self.region_ids, self.latitudes, self.longitudes, self.region_rows = fit_regions(tweets)
+        self.max_region = self.region_ids[-1]
 
-        self.s = self.regions.shape[0]
+        self.s = self.region_ids.shape[0]
         self.exploration_prob = self.p * (self.s ** -self.gamma)
 
     def update_s(self):
         self.s += 1
         self.exploration_prob = self.p * (self.s ** -self.gamma)
 
-    def next(self, prev):
+    def next(self, prev, rng=np.random):
         """
         Draws the next visit, either by exploration or return.
         The model must be `fit` before this can be called.
@@ -75,24 +89,48 @@ class PreferentialReturn:
         :param prev:
         Previous return from this function.
 
+        :param rng:
+        Source of random numbers, np.random or a np.random.Generator.
+
         :return:
         For exploration a list ["point", latitude, longitude, -1]
         For return a list ["region", latitude, longitude, region]
         """
-        r = np.random.uniform(0, 1)
+        r = rng.random()
         if r < self.exploration_prob:
             prev_lat, prev_lng = prev[1], prev[2]
-            bearing, jump_size_m = self.direction_jump_size_sampling.sample()
+            bearing, jump_size_m = self.direction_jump_size_sampling.sample(rng=rng)
             lat, lng = latlngshift(prev_lat, prev_lng, jump_size_m, bearing)
             self.update_s()
-            return ["point", lat, lng, max(self.regions.index) + 1]
+            return ["point", lat, lng, self.max_region + 1]
         else:
             previous_region_idx = None
             if prev[0] == 'region':
                 previous_region_idx = prev[3]
-            region_idx = self.region_sampling.sample(previous_region_idx=previous_region_idx, previous_point=prev)
-            region = self.regions.loc[region_idx]
-            return ["region", region.latitude, region.longitude, region_idx]
+            region_idx = self.region_sampling.sample(previous_region_idx=previous_region_idx, previous_point=prev,
+                                                     rng=rng)
+            row = self.region_rows[region_idx]
+            return ["region", self.latitudes[row], self.longitudes[row], region_idx]
+
+
+def fit_regions(tweets):
+    """
+    Locates every region of a user at its first visit.
+
+    :param tweets:
+    pd.DataFrame (region, latitude, longitude, ...rest)
+
+    :return:
+    Region ids (sorted), their latitudes and longitudes as contiguous float64 arrays,
+    and an array mapping a region id to its row.
+    """
+    regions = tweets.groupby('region').head(1).set_index('region').sort_index()
+    region_ids = regions.index.values
+    latitudes = np.ascontiguousarray(regions.latitude.values, dtype=np.float64)
+    longitudes = np.ascontiguousarray(regions.longitude.values, dtype=np.float64)
+    region_rows = np.full(region_ids[-1] + 1, -1, dtype=np.int64)
+    region_rows[region_ids] = np.arange(region_ids.shape[0])
+    return region_ids, latitudes, longitudes, region_rows
 
 
 def latlngshift(lat, lng, delta_m, bearing):
@@ -113,6 +151,22 @@ def latlngshift(lat, lng, delta_m, bearing):
     return np.degrees(lat2), np.degrees(lng2)
 
 
+def latlngshift_many(lat, lng, jumps):
+    """
+    Batch form of latlngshift.
+
+    :param lat, lng:
+    Arrays of starting points in degrees.
+
+    :param jumps:
+    (k, 2) array of (bearing, jump size in metres), e.g. from JumpSizeDirectionTrueProb.sample_many.
+
+    :return:
+    (k, 2) array of the shifted latitudes and longitudes.
+    """
+    return np.column_stack(latlngshift(lat, lng, jumps[:, 1], jumps[:, 0]))
+
+
 class RegionTrueProb:
     """
     A region probability sampler that follows the true distribution of observed regions.
@@ -120,6 +174,7 @@ class RegionTrueProb:
 
     def __init__(self):
         self.region_probs = None
+        self.alias = None
 
     def describe(self):
         return {
@@ -129,13 +184,13 @@ class RegionTrueProb:
     def fit(self, tweets):
         visits = tweets.groupby('region').size().sort_values(ascending=False)
         self.region_probs = visits / visits.sum()
+        self.alias = simulation.AliasTable(self.region_probs.values)
 
-    def sample(self, previous_region_idx=None):
-        return np.random.choice(
-            a=self.region_probs.index,
-            p=self.region_probs.values,
-            size=1,
-        )[0]
+    def sample(self, previous_region_idx=None, previous_point=None, rng=np.random):
+        return self.region_probs.index[self.alias.sample(rng=rng)]
+
+    def sample_many(self, k, previous_region_idx=None, rng=np.random):
+        return self.region_probs.index.values[self.alias.sample(size=k, rng=rng)]
 
 
 class RegionZipfProb:
@@ -150,6 +205,7 @@ class RegionZipfProb:
     def __init__(self, s=1.2):
         self.s = s
         self.region_probs = None
+        self.alias = None
 
     def describe(self):
         return {
@@ -161,108 +217,152 @@ class RegionZipfProb:
         visits = tweets.groupby('region').size().sort_values(ascending=False)
         probs = np.power(np.arange(1, visits.shape[0] + 1), -self.s)
         self.region_probs = pd.Series(probs / np.sum(probs), index=visits.index)
+        self.alias = simulation.AliasTable(self.region_probs.values)
+
+    def sample(self, previous_region_idx=None, previous_point=None, rng=np.random):
+        return self.region_probs.index[self.alias.sample(rng=rng)]
 
-    def sample(self, previous_region_idx=None):
-        return np.random.choice(
-            a=self.region_probs.index,
-            p=self.region_probs.values,
-            size=1,
-        )[0]
+    def sample_many(self, k, previous_region_idx=None, rng=np.random):
+        return self.region_probs.index.values[self.alias.sample(size=k, rng=rng)]
 
 
 class RegionTransitionZipf:
     """
     A region probability sampler that scales the observed probability of regions with
     the distance between regions.
+
+    :param snap_km:
+    Optional. When returning from a point closer than snap_km to a known region, the
+    transition row of that region is used instead of evaluating the distance decay from the point.
+    Since every distance changes by at most snap_km, the ratio between any two return
+    probabilities changes by at most a factor exp(2 * beta * snap_km).
+    Defaults to None, the exact distance decay.
     """
 
-    def __init__(self, zipfs=1.2, beta=0.03):
+    __slots__ = (
+        'zipfs', 'beta', 'snap_km', 'region_ids', 'latitudes', 'longitudes', 'region_rows',
+        'coords_rad', 'cos_lat', 'distances', 'transition_mx', 'region_probabilities', 'transition_alias',
+    )
+
+    def __init__(self, zipfs=1.2, beta=0.03, snap_km=None):
         self.zipfs = zipfs
         self.beta = beta
-
+        self.snap_km = snap_km
+
+        # Fitted regions, sorted by region id; matrices are indexed by region row
+        self.region_ids = None
+        self.latitudes = None
+        self.longitudes = None
+        self.region_rows = None
+        # Region coordinates in radians and the cosine of their latitudes, cached for returns from points
+        self.coords_rad = None
+        self.cos_lat = None
         self.distances = None
-        self.seed = None
         # When previous visit was to a region transition is used
         self.transition_mx = None
+        self.transition_alias = None
         # When previous visit was to a random point global prob is used
         self.region_probabilities = None
-        self.regions = None
 
     def describe(self):
         return {
             "name": "transitionZipf",
             "zipfs": self.zipfs,
             "beta": self.beta,
+            "snap_km": self.snap_km,
         }
 
     def fit(self, tweets):
-        reggrp = tweets.groupby('region')
-        regions = reggrp.head(1).set_index('region').sort_index()
-        self.regions = regions
-        distances_km = pd.DataFrame(
-            (6371.0088 * haversine_distances(
-                np.radians(regions[['latitude', 'longitude']]),
-            )),
-            index=regions.index,
-            columns=regions.index,
-        )
-        self.distances = distances_km.stack()
-        seed = np.exp(-self.beta * distances_km)
-        seed += 0.0000001
-        seed = seed.div(seed.sum(axis=1), axis=0)
-        self.seed = seed
+        self.region_ids, self.latitudes, self.longitudes, self.region_rows = fit_regions(tweets)
+        n_regions = self.region_ids.shape[0]
+        self.coords_rad = np.radians(np.column_stack([self.latitudes, self.longitudes]))
+        self.cos_lat = np.cos(self.coords_rad[:, 0])
+        self.distances = 6371.0088 * haversine_distances(self.coords_rad)
 
-        region_counts = reggrp.size().sort_values(ascending=False)
+        region_counts = tweets.groupby('region').size().sort_values(ascending=False)
         region_probs = np.power(
             np.arange(1, region_counts.shape[0] + 1),
             -self.zipfs,
         )
         region_probs += 0.0000001
-        region_probs = pd.Series(
-            region_probs / np.sum(region_probs),
-            index=region_counts.index,
-        ).sort_index()
-        self.region_probabilities = region_probs
-        fitted = region_probs * seed
-        fitted = fitted.div(fitted.sum(axis=1), axis=0)
-        self.transition_mx = fitted.stack()
+        region_probs = region_probs / np.sum(region_probs)
+        self.region_probabilities = np.empty(n_regions)
+        self.region_probabilities[self.region_rows[region_counts.index.values]] = region_probs
+        self.refit(self.beta)
 
-    def probs_from_point(self, prev):
-        regions = self.regions
-        distances_km = pd.DataFrame(
-            (6371.0088 * haversine_distances(
-                np.radians(regions[['latitude', 'longitude']]),
-                Y=np.radians([[prev[1], prev[2]]]),
-            )),
-            index=regions.index,
-            columns=["c"],
+    def refit(self, beta=None):
+        """
+        Recomputes the transitions for another beta. The regions, their distances and
+        zipf probabilities do not depend on beta and are kept from `fit`.
+        Without `beta` the transitions are recomputed for the current one.
+        """
+        if beta is not None:
+            self.beta = beta
+        n_regions = self.region_ids.shape[0]
+        seed = np.exp(-self.beta * self.distances)
+        seed += 0.0000001
+        seed /= seed.sum(axis=1, keepdims=True)
+
+        fitted = self.region_probabilities * seed
+        fitted /= fitted.sum(axis=1, keepdims=True)
+        self.transition_mx = fitted
+        self.transition_alias = simulation.AliasTable(
+            fitted.ravel(),
+            np.arange(0, n_regions * n_regions + 1, n_regions),
         )
-        distances_km = distances_km.loc[distances_km['c'] > 0, :]
-        distances_km = distances_km.c
-        region_probs = self.region_probabilities
-        prob = region_probs * np.exp(-self.beta * distances_km)
-        prob += 0.0000001
-        prob = prob / prob.sum()
-        return prob
-
-    def sample(self, previous_region_idx=None, previous_point=None):
+
+    def point_distances(self, lat, lng):
+        """
+        :return:
+        Distance in km from (lat, lng) in degrees to each region.
+        """
+        lat, lng = np.radians(lat), np.radians(lng)
+        a = np.sin((self.coords_rad[:, 0] - lat) / 2) ** 2 + \
+            self.cos_lat * np.cos(lat) * np.sin((self.coords_rad[:, 1] - lng) / 2) ** 2
+        return 6371.0088 * 2 * np.arcsin(np.sqrt(a))
+
+    def point_weights(self, distances_km):
+        weights = self.region_probabilities * np.exp(-self.beta * distances_km)
+        weights += 0.0000001
+        # Regions at the very point are not returned to
+        weights[distances_km <= 0] = 0
+        return weights
+
+    def probs_from_point(self, prev):
+        """
+        :return:
+        Probabilities of returning to each region (ordered as region_ids) from the point in `prev`.
+        """
+        prob = self.point_weights(self.point_distances(prev[1], prev[2]))
+        return prob / prob.sum()
+
+    def sample(self, previous_region_idx=None, previous_point=None, rng=np.random):
         if previous_region_idx is None:
-            probs = self.probs_from_point(previous_point)
-        else:
-            probs = self.transition_mx.loc[previous_region_idx]
-        return np.random.choice(
-            a=probs.index,
-            p=probs.values,
-            size=1,
-        )[0]
+            distances_km = self.point_distances(previous_point[1], previous_point[2])
+            if self.snap_km is not None:
+                row = np.argmin(distances_km)
+                if distances_km[row] <= self.snap_km:
+                    return self.region_ids[self.transition_alias.sample(row=row, rng=rng)]
+            cs = np.cumsum(self.point_weights(distances_km))
+            col = np.searchsorted(cs, rng.random() * cs[-1], side='right')
+            return self.region_ids[min(col, cs.shape[0] - 1)]
+        row = self.region_rows[previous_region_idx]
+        return self.region_ids[self.transition_alias.sample(row=row, rng=rng)]
+
+    def sample_many(self, k, previous_region_idx=None, rng=np.random):
+        row = self.region_rows[previous_region_idx]
+        return self.region_ids[self.transition_alias.sample(row=row, size=k, rng=rng)]
 
 
 class JumpSizeDirectionTrueProb:
     """
     Sample from the joint probability distribution of bearing and jump size.
+    The observed pairs are kept as an (n, 2) kernel of (bearing, jump size in metres),
+    with the bearing as consumed by latlngshift.
     """
 
     def __init__(self):
+        self.kernel = None
         self.bearings = None
         self.jump_sizes_km = None
 
@@ -274,26 +374,26 @@ class JumpSizeDirectionTrueProb:
     def fit(self, tweets):
         gaps = helpers.gaps(tweets)
         gaps = gaps[gaps['region_origin'] != gaps['region_destination']]
-        bearings = helpers.coordinates_bearing(
-            gaps.latitude_origin.values,
-            gaps.longitude_origin.values,
-            gaps.latitude_destination.values,
-            gaps.longitude_destination.values,
-        )
         lines = gaps[[
             'latitude_origin', 'longitude_origin',
             'latitude_destination', 'longitude_destination',
-        ]].values
-        self.bearings = bearings
-        self.jump_sizes_km = [6371.0088 * haversine_distances(
-            X=np.radians([_[:2]]),
-            Y=np.radians([_[2:]]),
-        )[0, 0] for _ in lines]
-
-    def sample(self):
-        joints = np.array(tuple(zip(self.bearings, self.jump_sizes_km)))
-        idx = np.random.randint(joints.shape[0], size=1)[0]
-        return joints[idx, 0], joints[idx, 1] * 1000
+        ]].values.astype(np.float64)
+        bearings = helpers.coordinates_bearing(lines[:, 0], lines[:, 1], lines[:, 2], lines[:, 3])
+        jump_sizes_km = simulation.haversine_km(lines[:, 0], lines[:, 1], lines[:, 2], lines[:, 3])
+        self.kernel = np.ascontiguousarray(np.column_stack([bearings, jump_sizes_km * 1000]))
+        self.bearings = self.kernel[:, 0]
+        self.jump_sizes_km = jump_sizes_km
+
+    def sample(self, rng=np.random):
+        idx = int(rng.random() * self.kernel.shape[0])
+        return self.kernel[idx, 0], self.kernel[idx, 1]
+
+    def sample_many(self, k, rng=np.random):
+        """
+        :return:
+        (k, 2) array of (bearing, jump size in metres).
+        """
+        return self.kernel[(rng.random(k) * self.kernel.shape[0]).astype(np.int64)]
 
 
 class Sampler:
@@ -305,9 +405,24 @@ class Sampler:
 
     :param daily_trips_sampling:
     How many trips should be sampled every day.
+
+    :param engine:
+    How visits are generated.
+    'loop' samples user by user and trip by trip with the model.
+    'batch' packs the fitted model of all users into arrays and advances them together.
+    'jit' packs the fitted model like 'batch' and runs each user's loop in a kernel compiled with numba
+    (plain Python if numba is not installed). For the same seed it gives the same visits as 'batch'.
+
+    :param top_k:
+    Optional, 'batch' and 'jit' only. Truncates the transition rows of users with many regions,
+    see simulation.truncated_kernels. Defaults to None, exact transitions.
+
+    :param seed:
+    Seed of the per-user random streams. Every user gets its own stream spawned from the seed,
+    so a given seed reproduces the same visits for any number of processes. Defaults to fresh entropy.
     """
 
-    def __init__(self, model=None, daily_trips_sampling=None, n_days=1):
+    def __init__(self, model=None, daily_trips_sampling=None, n_days=1, engine='loop', seed=None, top_k=None):
         if model is None:
             raise Exception("model must be set")
         self.model = model
@@ -318,20 +433,32 @@ class Sampler:
 
         self.n_days = n_days
 
+        if engine not in ('loop', 'batch', 'jit'):
+            raise Exception("engine must be 'loop', 'batch' or 'jit'")
+        self.engine = engine
+        self.seed = seed
+        self.top_k = top_k
+
     def describe(self):
         return {
             "model": self.model.describe(),
             "daily_trips_sampling": self.daily_trips_sampling.describe(),
-            "n_days": self.n_days
+            "n_days": self.n_days,
+            "engine": self.engine,
+            "seed": self.seed,
+            "top_k": self.top_k,
         }
 
-    def sample_user(self, tweets=None, uid=None):
+    def sample_user(self, tweets=None, uid=None, seed=None):
         """
         Samples new visits for a given user in `tweets` for `n_days`.
 
         :param tweets:
         pd.DataFrame (userid*, region, label, latitude, longitude, ...rest))
 
+        :param seed:
+        Seed of the user's random stream.
+
         :param n_days:
         How many days should be sampled.
 
@@ -340,6 +467,7 @@ class Sampler:
         pd.DataFrame (*userid, day, timeslot, kind, latitude, longitude, region)
         """
         usamples = []
+        rng = np.random.default_rng(seed)
         utweets = tweets.loc[uid]
         # Re-fit the model on this user
         self.model.fit(utweets)
@@ -354,8 +482,8 @@ class Sampler:
 
             # For exploration a list ["point", latitude, longitude, new_regionidx]
             # For return a list ["region", latitude, longitude, region]
-            for timeslot in range(self.daily_trips_sampling.sample()):
-                current = self.model.next(prev)
+            for timeslot in range(self.daily_trips_sampling.sample(rng=rng)):
+                current = self.model.next(prev, rng=rng)
                 usamples.append([uid, day, (timeslot + 1)] + current)
                 prev = current
         return pd.DataFrame(
@@ -363,6 +491,38 @@ class Sampler:
             columns=['userid', 'day', 'timeslot', 'kind', 'latitude', 'longitude', 'region'],
         )
 
+    def sample_batch(self, tweets=None, seeds=None):
+        """
+        Samples new visits for all users in `tweets` with the array-based engine ('batch' or 'jit').
+
+        :param tweets:
+        pd.DataFrame (userid*, region, label, latitude, longitude, ...rest))
+
+        :param seeds:
+        Seeds of the users' random streams, in the order of the users in `tweets`.
+
+        :return:
+        The sampled visits for the given users as a VisitBatch
+        """
+        if isinstance(self.model.region_sampling, RegionTransitionZipf) and \
+                isinstance(self.model.direction_jump_size_sampling, JumpSizeDirectionTrueProb):
+            sampling = self.model.region_sampling
+            store = simulation.UserStore.from_tweets(tweets, zipfs=sampling.zipfs, beta=sampling.beta,
+                                                     snap_km=sampling.snap_km, top_k=self.top_k)
+        else:
+            store = simulation.UserStore.from_model(self.model, tweets)
+        if seeds is None:
+            seeds = np.random.SeedSequence().spawn(store.n_users)
+        return simulation.simulate(
+            store,
+            p=self.model.p,
+            gamma=self.model.gamma,
+            daily_trips_sampling=self.daily_trips_sampling,
+            n_days=self.n_days,
+            rngs=[np.random.default_rng(seed) for seed in seeds],
+            engine='batch' if self.engine == 'loop' else self.engine,
+        )
+
     def sample(self, tweets=None):
         """
         Paralleized sampling of new visits for all users in `tweets`.
@@ -376,14 +536,90 @@ class Sampler:
         if tweets is None:
             raise Exception("must set tweets when sampling")
 
-        # parallelize the generation of visits over days
-        pool = mp.Pool(mp.cpu_count())
-        samples_list = pool.starmap(self.sample_user,
-                                   [(tweets, uid) for uid in tweets.index.unique()])
-        visits_total = pd.concat(samples_list).set_index('userid')
+        # Split the tweets by user once; every task only carries its own rows
+        if not tweets.index.is_monotonic_increasing:
+            tweets = tweets.sort_index(kind='stable')
+        slices = helpers.user_slices(tweets)
+        seeds = np.random.SeedSequence(self.seed).spawn(len(slices))
+        processes = mp.cpu_count()
+
+        pool = mp.Pool(processes)
+        if self.engine != 'loop':
+            # One contiguous chunk of users per process, each simulated as a whole
+            chunks = [c for c in np.array_split(np.arange(len(slices)), processes) if len(c) > 0]
+            samples_list = pool.starmap(self.sample_batch,
+                                        [(tweets.iloc[slices[c[0]][1]:slices[c[-1]][2]], seeds[c[0]:c[-1] + 1])
+                                         for c in chunks])
+            visits_total = VisitBatch.concat(samples_list).to_frame()
+        else:
+            # parallelize the generation of visits over users
+            samples_list = pool.starmap(self.sample_user,
+                                        ((tweets.iloc[start:stop], uid, seed)
+                                         for (uid, start, stop), seed in zip(slices, seeds)),
+                                        chunksize=max(1, len(slices) // (4 * processes)))
+            visits_total = pd.concat(samples_list).set_index('userid')
         pool.close()
         return visits_total
 
+    def sample_block(self, tweets=None, seeds=None):
+        """
+        Samples new visits for a block of consecutive users in `tweets` with the selected engine.
+
+        :param seeds:
+        Seeds of the users' random streams, in the order of the users in `tweets`.
+
+        :return:
+        VisitBatch
+        """
+        if self.engine != 'loop':
+            return self.sample_batch(tweets, seeds)
+        return VisitBatch.from_frame(pd.concat([
+            self.sample_user(tweets.iloc[start:stop], uid, seed)
+            for (uid, start, stop), seed in zip(helpers.user_slices(tweets), seeds)
+        ]))
+
+    def _sample_block_task(self, task):
+        return self.sample_block(*task)
+
+    def iter_samples(self, tweets=None, batch_users=1000):
+        """
+        Streaming form of `sample`: yields the visits of `batch_users` users at a time.
+        At most two blocks per worker are sampled ahead of the consumer, so that only a few
+        blocks are held in memory at once.
+        A user's visits are the same as from `sample` with the same seed.
+
+        :param tweets:
+        pd.DataFrame (userid*, region, label, latitude, longitude, ...rest))
+
+        :param batch_users:
+        Number of users per block.
+
+        :return:
+        Generator of VisitBatch, in the order of the users.
+        """
+        if tweets is None:
+            raise Exception("must set tweets when sampling")
+
+        if not tweets.index.is_monotonic_increasing:
+            tweets = tweets.sort_index(kind='stable')
+        slices = helpers.user_slices(tweets)
+        seeds = np.random.SeedSequence(self.seed).spawn(len(slices))
+        tasks = ((tweets.iloc[slices[first][1]:slices[min(first + batch_users, len(slices)) - 1][2]],
+                  seeds[first:first + batch_users])
+                 for first in range(0, len(slices), batch_users))
+
+        processes = mp.cpu_count()
+        with mp.Pool(processes) as pool:
+            # At most two blocks per process are in flight, the next one is submitted once one is taken
+            pending = [pool.apply_async(self._sample_block_task, (task,))
+                       for task in itertools.islice(tasks, 2 * processes)]
+            while pending:
+                visits = pending.pop(0).get()
+                task = next(tasks, None)
+                if task is not None:
+                    pending.append(pool.apply_async(self._sample_block_task, (task,)))
+                yield visits
+
     def visits(self):
         if self._visits is None:
             geotweets = helpers.read_geotweets_raw(self.geotweets_path).set_index('userid')
@@ -404,6 +640,74 @@ class Sampler:
         return self._visits
 
 
+class VisitBatch:
+    """
+    Struct-of-arrays container of sampled visits, ordered by user, day and timeslot.
+    Much smaller than the equivalent DataFrame and cheap to ship back from worker processes.
+
+    :param kind:
+    uint8 codes into VisitBatch.KINDS, 0 for a region and 1 for a point.
+    """
+    KINDS = np.array(['region', 'point'])
+
+    __slots__ = ('userid', 'day', 'timeslot', 'kind', 'latitude', 'longitude', 'region')
+
+    def __init__(self, userid=None, day=None, timeslot=None, kind=None, latitude=None, longitude=None, region=None):
+        self.userid = np.asarray(userid)
+        self.day = np.asarray(day, dtype=np.uint16)
+        self.timeslot = np.asarray(timeslot, dtype=np.uint8)
+        self.kind = np.asarray(kind, dtype=np.uint8)
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        self.region = np.asarray(region, dtype=np.int32)
+
+    def __len__(self):
+        return self.day.shape[0]
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, column).nbytes for column in self.__slots__)
+
+    @classmethod
+    def from_frame(cls, visits):
+        """
+        :param visits:
+        pd.DataFrame (userid(*), day, timeslot, kind, latitude, longitude, region)
+        """
+        if 'userid' not in visits:
+            visits = visits.reset_index()
+        kind = visits.kind.values
+        return cls(
+            userid=visits.userid.values,
+            day=visits.day.values,
+            timeslot=visits.timeslot.values,
+            kind=(np.asarray(kind) == 'point'),
+            latitude=visits.latitude.values,
+            longitude=visits.longitude.values,
+            region=visits.region.values,
+        )
+
+    @classmethod
+    def concat(cls, batches):
+        batches = list(batches)
+        return cls(*[np.concatenate([getattr(b, column) for b in batches]) for column in cls.__slots__])
+
+    def to_frame(self):
+        """
+        :return:
+        pd.DataFrame (userid*, day, timeslot, kind, latitude, longitude, region) with a categorical kind.
+        """
+        return pd.DataFrame({
+            'userid': self.userid,
+            'day': self.day,
+            'timeslot': self.timeslot,
+            'kind': pd.Categorical.from_codes(self.kind, categories=self.KINDS),
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+            'region': self.region,
+        }).set_index('userid')
+
+
 class StaticDistribution:
     def __init__(self, n):
         self.n = n
@@ -414,7 +718,16 @@ class StaticDistribution:
             "n": self.n,
         }
 
-    def sample(self):
+    def sample(self, rng=np.random):
+        return self.n
+
+    def sample_many(self, size, rng=np.random):
+        return np.full(size, self.n)
+
+    def ppf(self, u):
+        return np.full(np.shape(u), self.n, dtype=np.int64)
+
+    def max_value(self):
         return self.n
 
 
@@ -430,8 +743,22 @@ class NormalDistribution:
             "std": self.std,
         }
 
-    def sample(self):
-        return max(1, int(round(np.random.normal(self.mean, self.std))))
+    def sample(self, rng=np.random):
+        return max(1, int(round(rng.normal(self.mean, self.std))))
+
+    def sample_many(self, size, rng=np.random):
+        return np.maximum(1, np.round(rng.normal(self.mean, self.std, size=size))).astype(np.int64)
+
+    def ppf(self, u):
+        """
+        Number of trips at the quantiles `u`, truncated to [1, max_value()].
+        """
+        trips = np.round(self.mean + self.std * special.ndtri(u))
+        return np.clip(trips, 1, self.max_value()).astype(np.int64)
+
+    def max_value(self):
+        # Eight standard deviations above the mean, i.e. practically never truncated
+        return max(1, int(np.ceil(self.mean + 8 * self.std)))
 
 
 class WeightedDistribution:
@@ -446,8 +773,19 @@ class WeightedDistribution:
             "range": '2-27'
         }
 
-    def sample(self):
-        return random.choices(self.values, weights=self.weights, k=1)[0]
+    def sample(self, rng=np.random):
+        return int(self.ppf(rng.random()))
+
+    def sample_many(self, size, rng=np.random):
+        return self.ppf(rng.random(size))
+
+    def ppf(self, u):
+        cs = np.cumsum(self.weights)
+        idx = np.searchsorted(cs, np.asarray(u) * cs[-1], side='right')
+        return np.asarray(self.values, dtype=np.int64)[np.minimum(idx, len(self.values) - 1)]
+
+    def max_value(self):
+        return max(self.values)
 
 
 class VisitsFromFile:
@@ -2,6 +2,7 @@ import geopandas as gpd
 import pandas as pd
 import os
 import subprocess
+import lib.genericvalidation as genericvalidation
 
 
 def get_repo_root():
@@ -74,7 +75,4 @@ class GroundTruthLoader:
         trips['dest_zip'] = trips['dest_zip'].astype('int64')
         odms = trips.groupby(['origin_zip', 'dest_zip']).sum()['weight_trip']
         print(odms.head())
-        z = self.zones.zone
-        odms = odms.reindex(pd.MultiIndex.from_product([z, z], names=['ozone', 'dzone']), fill_value=0)
-        print(odms.head())
-        self.odm = odms / odms.sum()
+        self.odm = genericvalidation.SparseODM.from_series(odms, self.zones).normalize()
@@ -2,6 +2,7 @@ import geopandas as gpd
 import pandas as pd
 import os
 import subprocess
+import lib.genericvalidation as genericvalidation
 
 
 def get_repo_root():
@@ -48,6 +49,6 @@ class GroundTruthLoader:
         odms = pd.read_excel(ROOT_dir + "/dbs/saopaulo/odm/odm.xlsx", skiprows=7, index_col=0, skipfooter=3).drop(columns="Total")
         assert odms.shape[0] == 517
         assert odms.shape[1] == 517
-        odms = odms.stack()
-        self.odm = odms / odms.sum()
+        # Rows and columns follow the zones
+        self.odm = genericvalidation.SparseODM.from_dense(odms.fillna(0).values, self.zones).normalize()
 
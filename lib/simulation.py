@@ -0,0 +1,1284 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.neighbors import BallTree
+import multiprocessing as mp
+import itertools
+import lib.helpers as helpers
+import lib.models as models
+import lib.genericvalidation as genericvalidation
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+class UserStore:
+    """
+    Packed fitted state of the preferential return model for a group of users.
+    Per-user arrays are concatenated and addressed with CSR-style offsets,
+    i.e. the regions of user i are the rows region_ptr[i]:region_ptr[i + 1].
+
+    :param userids:
+    Users in the store, in the order their arrays are packed.
+
+    :param region_ptr:
+    Offsets into the flat region arrays, length n_users + 1.
+
+    :param region_ids, latitudes, longitudes:
+    Region label and coordinates (degrees) of every region, sorted by region within a user.
+
+    :param home_rows:
+    Flat row of each user's home region.
+
+    :param jump_ptr, jumps:
+    Offsets and (n, 2) array of observed (bearing, jump size in metres) per user.
+
+    :param region_probs:
+    Probability of returning to a region when the previous visit was not a region.
+
+    :param transitions:
+    AliasTable with one row per region holding the user's transition probabilities
+    from that region, or None when returns do not depend on the previous region.
+
+    :param beta:
+    Distance decay applied to returns from explored points, or None.
+
+    :param distances:
+    Flat distances in km of the entries of the transition rows, laid out like `transitions`
+    (see kernel_layout), kept to `refit` the transitions for another beta. None when there are no transitions.
+
+    :param kernel_ptr, kernel_cols:
+    Only for truncated transition rows, see truncated_kernels: offsets of the entries of every region row
+    and the destination region (column within the user) of every entry, -1 for the residual entry.
+    None when every row holds all regions of the user.
+
+    :param region_counts:
+    Optional number of tweets in every region.
+
+    :param snap_km:
+    Returns from points this close to a region follow the region's transitions, see
+    models.RegionTransitionZipf.
+    """
+
+    def __init__(self, userids=None, region_ptr=None, region_ids=None, latitudes=None, longitudes=None,
+                 home_rows=None, jump_ptr=None, jumps=None, region_probs=None, transitions=None, beta=None,
+                 snap_km=None, distances=None, region_counts=None, kernel_ptr=None, kernel_cols=None):
+        self.userids = userids
+        self.region_ptr = region_ptr
+        self.region_ids = region_ids
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.home_rows = home_rows
+        self.jump_ptr = jump_ptr
+        self.jumps = jumps
+        self.region_probs = region_probs
+        self.transitions = transitions
+        self.beta = beta
+        self.snap_km = snap_km
+        self.distances = distances
+        self.region_counts = region_counts
+        self.kernel_ptr = kernel_ptr
+        self.kernel_cols = kernel_cols
+
+    @property
+    def n_users(self):
+        return len(self.userids)
+
+    @property
+    def n_regions(self):
+        return np.diff(self.region_ptr)
+
+    @classmethod
+    def from_model(cls, model, tweets):
+        """
+        Fits `model` to every user in `tweets` and packs the fitted state.
+
+        :param model:
+        The initialized preferential return model.
+
+        :param tweets:
+        pd.DataFrame (userid*, region, label, latitude, longitude, ...rest))
+        """
+        userids = tweets.index.unique()
+        n_regions, n_jumps = [], []
+        region_ids, latitudes, longitudes, home_rows = [], [], [], []
+        jumps, region_probs, transitions, distances = [], [], [], []
+        beta = getattr(model.region_sampling, 'beta', None)
+        for uid in userids:
+            utweets = tweets.loc[uid]
+            model.fit(utweets)
+            ids = model.region_ids
+            home = utweets[utweets['label'] == 'home'].iloc[0]
+            home_rows.append(sum(n_regions) + model.region_rows[home.region])
+            n_regions.append(len(ids))
+            region_ids.append(ids)
+            latitudes.append(model.latitudes)
+            longitudes.append(model.longitudes)
+
+            sampling = model.direction_jump_size_sampling
+            n_jumps.append(sampling.kernel.shape[0])
+            jumps.append(sampling.kernel)
+
+            sampling = model.region_sampling
+            if hasattr(sampling, 'transition_alias'):
+                region_probs.append(sampling.region_probabilities)
+                transitions.append(sampling.transition_alias)
+                distances.append(sampling.distances.ravel())
+            else:
+                region_probs.append(sampling.region_probs.reindex(ids).values)
+
+        return cls(
+            userids=userids,
+            region_ptr=np.concatenate([[0], np.cumsum(n_regions)]),
+            region_ids=np.concatenate(region_ids),
+            latitudes=np.concatenate(latitudes),
+            longitudes=np.concatenate(longitudes),
+            home_rows=np.asarray(home_rows),
+            jump_ptr=np.concatenate([[0], np.cumsum(n_jumps)]),
+            jumps=np.concatenate(jumps),
+            region_probs=np.concatenate(region_probs),
+            transitions=AliasTable.concatenate(transitions) if transitions else None,
+            beta=beta if transitions else None,
+            snap_km=getattr(model.region_sampling, 'snap_km', None),
+            distances=np.concatenate(distances) if transitions else None,
+        )
+
+    @classmethod
+    def from_tweets(cls, tweets, zipfs=1.2, beta=0.03, snap_km=None, top_k=None):
+        """
+        Fits the preferential return model with RegionTransitionZipf and JumpSizeDirectionTrueProb
+        to all users in one pass over `tweets`, instead of fitting them one by one as from_model does.
+        Regions with the same number of tweets are ranked by region id for their zipf probabilities.
+
+        :param tweets:
+        pd.DataFrame (userid*, region, label, latitude, longitude, ...rest)), with the rows of
+        every user contiguous and in chronological order. Every user needs a home tweet.
+        Users with tweets in a single region are left out.
+
+        :param top_k:
+        Optional. Truncates the transition rows of users with more than 2 * top_k regions,
+        see truncated_kernels. Defaults to None, full rows and exact transitions.
+        """
+        ids = tweets.index.values
+        starts = np.flatnonzero(np.concatenate([[True], ids[1:] != ids[:-1]]))
+        user = np.repeat(np.arange(starts.shape[0]), np.diff(np.concatenate([starts, [ids.shape[0]]])))
+        userids = tweets.index[starts]
+        n_users = len(userids)
+        region = tweets.region.values.astype(np.int64)
+        lat = tweets.latitude.values.astype(np.float64)
+        lng = tweets.longitude.values.astype(np.float64)
+
+        # Regions sorted by id within a user, located at their first tweet
+        order = np.lexsort((region, user))
+        first = np.concatenate([[True], (user[order][1:] != user[order][:-1]) |
+                                (region[order][1:] != region[order][:-1])])
+        rows = order[first]
+        region_user = user[rows]
+        n_regions = np.bincount(region_user, minlength=n_users)
+        region_ptr = np.concatenate([[0], np.cumsum(n_regions)])
+        region_ids = region[rows]
+        region_counts = np.diff(np.concatenate([np.flatnonzero(first), [ids.shape[0]]]))
+        tweet_rows = np.empty(ids.shape[0], dtype=np.int64)
+        tweet_rows[order] = np.cumsum(first) - 1
+
+        home = np.flatnonzero(tweets.label.values == 'home')
+        home = home[np.concatenate([[True], user[home][1:] != user[home][:-1]])] if home.size > 0 else home
+        if home.shape[0] != n_users:
+            raise Exception("every user must have a home tweet")
+
+        # Zipf probabilities by the rank of the regions' tweet counts
+        ranked = np.lexsort((region_ids, -region_counts, region_user))
+        rank = np.empty(rows.shape[0], dtype=np.int64)
+        rank[ranked] = np.arange(rows.shape[0]) - region_ptr[region_user[ranked]]
+        region_probs = np.power(rank + 1.0, -zipfs)
+        region_probs += 0.0000001
+        region_probs /= np.bincount(region_user, weights=region_probs, minlength=n_users)[region_user]
+
+        # Jumps between consecutive tweets of a user in different regions
+        gaps = np.flatnonzero((user[1:] == user[:-1]) & (region[1:] != region[:-1]))
+        n_jumps = np.bincount(user[gaps], minlength=n_users)
+        if (n_jumps == 0).any():
+            # Users with a single region have no jump to explore with
+            return cls.from_tweets(tweets[(n_jumps > 0)[user]], zipfs=zipfs, beta=beta, snap_km=snap_km, top_k=top_k)
+        bearings = helpers.coordinates_bearing(lat[gaps], lng[gaps], lat[gaps + 1], lng[gaps + 1])
+        jump_sizes_km = haversine_km(lat[gaps], lng[gaps], lat[gaps + 1], lng[gaps + 1])
+
+        latitudes, longitudes = lat[rows], lng[rows]
+        if top_k is None:
+            destinations, origins = segment_ranges(np.repeat(region_ptr[:-1], n_regions),
+                                                   np.repeat(n_regions, n_regions))
+            kernel_ptr, kernel_cols = None, None
+            distances = haversine_km(latitudes[origins], longitudes[origins],
+                                     latitudes[destinations], longitudes[destinations])
+        else:
+            kernel_ptr, kernel_cols, distances = truncated_kernels(region_ptr, latitudes, longitudes, rank, top_k)
+        store = cls(
+            userids=userids,
+            region_ptr=region_ptr,
+            region_ids=region_ids,
+            latitudes=latitudes,
+            longitudes=longitudes,
+            home_rows=tweet_rows[home],
+            jump_ptr=np.concatenate([[0], np.cumsum(n_jumps)]),
+            jumps=np.column_stack([bearings, jump_sizes_km * 1000]),
+            region_probs=region_probs,
+            snap_km=snap_km,
+            distances=distances,
+            region_counts=region_counts,
+            kernel_ptr=kernel_ptr,
+            kernel_cols=kernel_cols,
+        )
+        store = store.refit(beta)
+        if top_k is not None:
+            print("Truncated transitions to top_k =", top_k, "with a total variation of at most",
+                  store.truncation_error().max())
+        return store
+
+    def kernel_layout(self):
+        """
+        Layout of the flat entries of the transition rows: the offsets of every region row,
+        and the origin and destination region row of every entry (-1 for a residual entry).
+        """
+        row_user = np.repeat(np.arange(self.n_users), self.n_regions)
+        if self.kernel_ptr is None:
+            lengths = self.n_regions[row_user]
+            destinations, origins = segment_ranges(self.region_ptr[row_user], lengths)
+            return np.concatenate([[0], np.cumsum(lengths)]), origins, destinations
+        origins = np.repeat(np.arange(row_user.shape[0]), np.diff(self.kernel_ptr))
+        destinations = np.where(self.kernel_cols >= 0, self.region_ptr[row_user[origins]] + self.kernel_cols, -1)
+        return self.kernel_ptr, origins, destinations
+
+    def truncation_error(self):
+        """
+        Bound of the total variation distance between every truncated transition row and the exact one,
+        which is the probability of its residual entry (0 for full rows), see truncated_kernels.
+        """
+        indptr, origins, destinations = self.kernel_layout()
+        residual = destinations < 0
+        return np.bincount(origins[residual], weights=self.transitions.probabilities()[residual],
+                           minlength=self.region_ids.shape[0])
+
+    def refit(self, beta=None):
+        """
+        The same users with the transitions of RegionTransitionZipf for another beta,
+        recomputed for all regions of all users at once. Everything else does not depend
+        on beta and is shared with this store. Without `beta` the transitions are recomputed
+        for the current one.
+        """
+        if self.distances is None:
+            raise Exception("refit needs a store fitted with RegionTransitionZipf")
+        if beta is None:
+            beta = self.beta
+        if beta is None:
+            raise Exception("beta must be set")
+        n_rows = self.region_ids.shape[0]
+        indptr, row, col = self.kernel_layout()
+        residual = col < 0
+
+        seed = np.exp(-beta * self.distances)
+        seed += 0.0000001
+        seed /= np.bincount(row, weights=seed, minlength=n_rows)[row]
+        probs = self.region_probs[np.maximum(col, 0)]
+        if residual.any():
+            # The residual entry stands for the zipf probability of all regions left out of the row
+            kept = np.bincount(row[~residual], weights=probs[~residual], minlength=n_rows)
+            probs[residual] = np.maximum(1 - kept[row[residual]], 0)
+        fitted = probs * seed
+        fitted /= np.bincount(row, weights=fitted, minlength=n_rows)[row]
+
+        return UserStore(
+            userids=self.userids,
+            region_ptr=self.region_ptr,
+            region_ids=self.region_ids,
+            latitudes=self.latitudes,
+            longitudes=self.longitudes,
+            home_rows=self.home_rows,
+            jump_ptr=self.jump_ptr,
+            jumps=self.jumps,
+            region_probs=self.region_probs,
+            transitions=AliasTable(fitted, indptr),
+            beta=beta,
+            snap_km=self.snap_km,
+            distances=self.distances,
+            region_counts=self.region_counts,
+            kernel_ptr=self.kernel_ptr,
+            kernel_cols=self.kernel_cols,
+        )
+
+    def take(self, first, last):
+        """
+        The users first:last of the store, as views of its arrays.
+        """
+        regions = slice(self.region_ptr[first], self.region_ptr[last])
+        jumps = slice(self.jump_ptr[first], self.jump_ptr[last])
+        if self.kernel_ptr is None:
+            squares = np.concatenate([[0], np.cumsum(self.n_regions ** 2)])
+            entries = slice(squares[first], squares[last])
+        else:
+            entries = slice(self.kernel_ptr[regions.start], self.kernel_ptr[regions.stop])
+        transitions = None if self.transitions is None else self.transitions.take(regions.start, regions.stop)
+        return UserStore(
+            userids=self.userids[first:last],
+            region_ptr=self.region_ptr[first:last + 1] - regions.start,
+            region_ids=self.region_ids[regions],
+            latitudes=self.latitudes[regions],
+            longitudes=self.longitudes[regions],
+            home_rows=self.home_rows[first:last] - regions.start,
+            jump_ptr=self.jump_ptr[first:last + 1] - jumps.start,
+            jumps=self.jumps[jumps],
+            region_probs=self.region_probs[regions],
+            transitions=transitions,
+            beta=self.beta,
+            snap_km=self.snap_km,
+            distances=None if self.distances is None else self.distances[entries],
+            region_counts=None if self.region_counts is None else self.region_counts[regions],
+            kernel_ptr=None if self.kernel_ptr is None
+            else self.kernel_ptr[regions.start:regions.stop + 1] - entries.start,
+            kernel_cols=None if self.kernel_cols is None else self.kernel_cols[entries],
+        )
+
+    def save(self, path):
+        """
+        Writes the store to the directory `path`, one .npy file per array, so that `load`
+        can memory-map it.
+        """
+        os.makedirs(path, exist_ok=True)
+        arrays = {name: getattr(self, name) for name in _store_arrays}
+        arrays['userids'] = np.asarray(self.userids)
+        if self.transitions is not None:
+            arrays.update(transition_prob=self.transitions.prob, transition_alias=self.transitions.alias,
+                          transition_indptr=self.transitions.indptr)
+        arrays['params'] = np.array([np.nan if self.beta is None else self.beta,
+                                     np.nan if self.snap_km is None else self.snap_km])
+        for name, values in arrays.items():
+            if values is not None:
+                np.save(os.path.join(path, name + '.npy'), values)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Reads a store written by `save`. By default the arrays are memory-mapped read-only,
+        so processes loading the same store share its pages.
+        """
+        def read(name, mmap_mode=mmap_mode):
+            file = os.path.join(path, name + '.npy')
+            return np.load(file, mmap_mode=mmap_mode) if os.path.exists(file) else None
+
+        arrays = {name: read(name) for name in _store_arrays}
+        transitions = None
+        if os.path.exists(os.path.join(path, 'transition_prob.npy')):
+            transitions = AliasTable.__new__(AliasTable)
+            transitions.prob = read('transition_prob')
+            transitions.alias = read('transition_alias')
+            transitions.indptr = read('transition_indptr')
+        beta, snap_km = read('params', mmap_mode=None)
+        return cls(
+            # Userids may be objects, which cannot be memory-mapped
+            userids=pd.Index(np.load(os.path.join(path, 'userids.npy'), allow_pickle=True)),
+            transitions=transitions,
+            beta=None if np.isnan(beta) else float(beta),
+            snap_km=None if np.isnan(snap_km) else float(snap_km),
+            **arrays
+        )
+
+
+# Arrays of a UserStore written by UserStore.save, besides the userids and transitions
+_store_arrays = ('region_ptr', 'region_ids', 'latitudes', 'longitudes', 'home_rows', 'jump_ptr', 'jumps',
+                 'region_probs', 'distances', 'region_counts', 'kernel_ptr', 'kernel_cols')
+
+
+class AliasTable:
+    """
+    Walker alias tables for every row of a ragged (CSR-style) array of weights.
+    Building costs O(n) per row and every draw costs O(1) regardless of the row length.
+
+    :param weights:
+    Flat non-negative weights, row i is weights[indptr[i]:indptr[i + 1]].
+
+    :param indptr:
+    Row offsets into `weights`. Defaults to a single row.
+    """
+
+    def __init__(self, weights=None, indptr=None):
+        weights = np.asarray(weights, dtype=np.float64)
+        if indptr is None:
+            indptr = np.array([0, weights.shape[0]])
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        lengths = np.diff(self.indptr)
+        row = np.repeat(np.arange(len(lengths)), lengths)
+        totals = np.bincount(row, weights=weights, minlength=len(lengths))
+        q = weights * lengths[row] / totals[row]
+
+        self.prob = np.ones(weights.shape[0], dtype=np.float64)
+        self.alias = np.arange(weights.shape[0], dtype=np.int64) - self.indptr[row]
+
+        # All rows are paired in parallel: every iteration settles one entry of each unfinished row,
+        # the next small entry (or the previous large one that turned small) against the current large entry.
+        order = np.lexsort((q, row))
+        lo = self.indptr[:-1].copy()
+        hi = self.indptr[1:] - 1
+        pending = np.full(len(lengths), -1, dtype=np.int64)
+        active = np.flatnonzero(lengths > 1)
+        while active.size > 0:
+            has_pending = pending[active] >= 0
+            small = np.where(has_pending, pending[active], order[np.minimum(lo[active], hi[active])])
+            lo[active] += ~has_pending
+            large = order[hi[active]]
+            pair = (q[small] < 1) & (lo[active] <= hi[active])
+
+            small, large = small[pair], large[pair]
+            self.prob[small] = q[small]
+            self.alias[small] = large - self.indptr[row[large]]
+            q[large] -= 1 - q[small]
+
+            demoted = np.zeros(active.size, dtype=bool)
+            demoted[pair] = q[large] < 1
+            pending[active] = -1
+            pending[active[demoted]] = order[hi[active[demoted]]]
+            hi[active[demoted]] -= 1
+            active = active[(pending[active] >= 0) | (lo[active] <= hi[active])]
+
+    def draw(self, rows, u):
+        """
+        Draws one column from each of `rows` using one uniform number per draw:
+        its integer part (scaled by the row length) picks the column, its fraction the coin.
+
+        :return:
+        The column within the row (not the flat position).
+        """
+        lengths = self.indptr[rows + 1] - self.indptr[rows]
+        scaled = u * lengths
+        col = np.minimum(scaled.astype(np.int64), lengths - 1)
+        pos = self.indptr[rows] + col
+        return np.where(scaled - col < self.prob[pos], col, self.alias[pos])
+
+    def sample(self, row=0, size=None, rng=np.random):
+        """
+        Draws `size` columns (a single one if None) from `row`.
+        """
+        rows = np.full(1 if size is None else size, row, dtype=np.int64)
+        cols = self.draw(rows, rng.random(rows.size))
+        return cols[0] if size is None else cols
+
+    def probabilities(self):
+        """
+        Normalized weights of every row, recovered from the table (flat, aligned with the weights).
+        """
+        lengths = np.diff(self.indptr)
+        row = np.repeat(np.arange(len(lengths)), lengths)
+        moved = np.bincount(self.indptr[row] + self.alias, weights=1 - self.prob, minlength=self.prob.shape[0])
+        return (self.prob + moved) / lengths[row]
+
+    def take(self, first, last):
+        """
+        The rows first:last of the table, as views of its arrays.
+        """
+        table = AliasTable.__new__(AliasTable)
+        table.prob = self.prob[self.indptr[first]:self.indptr[last]]
+        table.alias = self.alias[self.indptr[first]:self.indptr[last]]
+        table.indptr = self.indptr[first:last + 1] - self.indptr[first]
+        return table
+
+    @classmethod
+    def concatenate(cls, tables):
+        """
+        Stacks the rows of several tables into one table.
+        """
+        table = cls.__new__(cls)
+        table.prob = np.concatenate([t.prob for t in tables])
+        table.alias = np.concatenate([t.alias for t in tables])
+        lengths = np.concatenate([np.diff(t.indptr) for t in tables])
+        table.indptr = np.concatenate([[0], np.cumsum(lengths)])
+        return table
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """
+    Elementwise great-circle distance in km between points given in degrees.
+    """
+    lat1, lng1, lat2, lng2 = np.radians(lat1), np.radians(lng1), np.radians(lat2), np.radians(lng2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 6371.0088 * 2 * np.arcsin(np.sqrt(a))
+
+
+def segment_ranges(starts, lengths):
+    """
+    Concatenated ranges [starts[i], starts[i] + lengths[i]) and the segment each element belongs to.
+    """
+    total = lengths.sum()
+    segment = np.repeat(np.arange(len(starts)), lengths)
+    first = np.cumsum(lengths) - lengths
+    return starts[segment] + np.arange(total) - first[segment], segment
+
+
+def segment_choice(weights, lengths, u):
+    """
+    Draws one element per segment of the flat `weights`, proportional to the weights,
+    using the uniform numbers `u` (one per segment).
+
+    :return:
+    Flat position of the chosen element of every segment.
+    """
+    cs = np.cumsum(weights)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    before = np.where(starts > 0, cs[np.maximum(starts - 1, 0)], 0.0)
+    picks = np.searchsorted(cs, before + u * (cs[ends - 1] - before), side='right')
+    return np.clip(picks, starts, ends - 1)
+
+
+def segment_argmin(values, lengths):
+    """
+    Flat position of the (first) smallest value of every segment of `values`.
+    """
+    starts = np.cumsum(lengths) - lengths
+    segment = np.repeat(np.arange(len(lengths)), lengths)
+    is_min = values == np.minimum.reduceat(values, starts)[segment]
+    positions = np.flatnonzero(is_min)
+    return positions[np.unique(segment[positions], return_index=True)[1]]
+
+
+def truncated_kernels(region_ptr, latitudes, longitudes, rank, top_k):
+    """
+    Sparse transition rows for users with many regions. The row of a region keeps its top_k nearest
+    regions (found with a BallTree) and the user's top_k regions by zipf rank, plus one residual entry
+    for all other regions. Users with at most 2 * top_k regions keep full rows.
+
+    Every left-out region j is at least as far as the top_k-th nearest region, at d_k, so the left-out
+    weights zp_j * (exp(-beta * d_j) + 1e-7) of a row sum to at most U = (exp(-beta * d_k) + 1e-7) * (1 - Z),
+    with Z the zipf probability of the kept regions. The residual entry gets the weight U, and a return
+    drawn to it picks a region of the user by its zipf probability. Whatever the residual draws,
+    the total variation distance between the truncated row and the exact one is at most U / (W + U),
+    with W the weight of the kept regions: the probability of the residual entry, see UserStore.truncation_error.
+    The bound is loose only for large top_k: on synthetic users with 20-40 regions it reached 0.37-0.72
+    with top_k=5 and 0.19-0.29 with top_k=10, depending on beta. Check truncation_error before using a small top_k.
+
+    :param rank:
+    Zipf rank (0 for the most visited) of every region within its user.
+
+    :return:
+    kernel_ptr, kernel_cols and distances as in UserStore, the residual entries at d_k.
+    """
+    n_regions = np.diff(region_ptr)
+    n_rows = region_ptr[-1]
+    row_user = np.repeat(np.arange(n_regions.shape[0]), n_regions)
+
+    full_rows = np.flatnonzero(n_regions[row_user] <= 2 * top_k)
+    destinations, segment = segment_ranges(region_ptr[row_user[full_rows]], n_regions[row_user[full_rows]])
+    # Origin, destination (-1 for the residual) and the region the distance is measured to of every entry
+    entries = [(full_rows[segment], destinations, destinations)]
+    for user in np.flatnonzero(n_regions > 2 * top_k):
+        first, last = region_ptr[user], region_ptr[user + 1]
+        coords = np.radians(np.column_stack([latitudes[first:last], longitudes[first:last]]))
+        _, nearest = BallTree(coords, metric='haversine').query(coords, k=top_k)
+        top = np.flatnonzero(rank[first:last] < top_k)
+        kept = np.sort(np.hstack([nearest, np.broadcast_to(top, (last - first, top.shape[0]))]), axis=1)
+        unique = np.concatenate([np.ones((last - first, 1), dtype=bool), kept[:, 1:] != kept[:, :-1]], axis=1)
+        origins = np.repeat(np.arange(first, last), unique.sum(axis=1))
+        entries.append((origins, first + kept[unique], first + kept[unique]))
+        entries.append((np.arange(first, last), np.full(last - first, -1), first + nearest[:, -1]))
+
+    origins, destinations, measured = [np.concatenate(columns) for columns in zip(*entries)]
+    order = np.lexsort((destinations, origins))
+    origins, destinations, measured = origins[order], destinations[order], measured[order]
+    kernel_ptr = np.concatenate([[0], np.cumsum(np.bincount(origins, minlength=n_rows))])
+    kernel_cols = np.where(destinations >= 0, destinations - region_ptr[row_user[origins]], -1)
+    distances = haversine_km(latitudes[origins], longitudes[origins], latitudes[measured], longitudes[measured])
+    return kernel_ptr, kernel_cols, distances
+
+
+def transition_rows(store, rows, u, u_residual, region_alias):
+    """
+    Draws the region rows reached from the region `rows` with the uniform numbers `u`.
+    A draw of the residual entry of a truncated row picks a region of the user from `region_alias`
+    (the zipf probabilities) with `u_residual` instead.
+    """
+    cols = store.transitions.draw(rows, u)
+    first = store.region_ptr[np.searchsorted(store.region_ptr, rows, side='right') - 1]
+    if store.kernel_cols is None:
+        return first + cols
+    cols = store.kernel_cols[store.transitions.indptr[rows] + cols]
+    residual = np.flatnonzero(cols < 0)
+    if residual.size > 0:
+        users = np.searchsorted(store.region_ptr, rows[residual], side='right') - 1
+        cols[residual] = region_alias.draw(users, u_residual[residual])
+    return first + cols
+
+
+# Compiled kernels and the scalar helpers they call, set by user_kernel
+_kernels = {}
+_latlngshift = _haversine_km = _alias_draw = _transition_draw = None
+
+
+def user_kernel():
+    """
+    The per-user simulation loop of simulate(engine='jit'), compiled with numba on first use.
+    Without numba the same loop runs as plain Python, which is correct but slow.
+    """
+    if 'simulate' not in _kernels:
+        global _latlngshift, _haversine_km, _alias_draw, _transition_draw
+        if numba is None:
+            _latlngshift, _haversine_km, _alias_draw = models.latlngshift, haversine_km, _alias_draw_py
+            _transition_draw = _transition_draw_py
+            _kernels['simulate'] = _simulate_users
+        else:
+            _latlngshift = numba.njit(models.latlngshift, cache=True)
+            _haversine_km = numba.njit(haversine_km, cache=True)
+            _alias_draw = numba.njit(_alias_draw_py, cache=True)
+            _transition_draw = numba.njit(_transition_draw_py, cache=True)
+            _kernels['simulate'] = numba.njit(_simulate_users, cache=True)
+    return _kernels['simulate']
+
+
+def _alias_draw_py(prob, alias, indptr, row, u):
+    length = indptr[row + 1] - indptr[row]
+    scaled = u * length
+    col = min(int(scaled), length - 1)
+    if scaled - col < prob[indptr[row] + col]:
+        return col
+    return alias[indptr[row] + col]
+
+
+def _transition_draw_py(prob, alias, indptr, kernel_cols, zipf_prob, zipf_alias, zipf_indptr, row, user,
+                        u, u_residual):
+    col = _alias_draw(prob, alias, indptr, row, u)
+    if kernel_cols.shape[0] == 0:
+        return col
+    col = kernel_cols[indptr[row] + col]
+    if col < 0:
+        return _alias_draw(zipf_prob, zipf_alias, zipf_indptr, user, u_residual)
+    return col
+
+
+def _simulate_users(first_day, trips, uniforms, s, p, gamma, region_ptr, latitudes, longitudes, region_ids,
+                    home_rows, jump_ptr, jumps, region_probs, returns_prob, returns_alias, returns_indptr,
+                    kernel_cols, zipf_prob, zipf_alias, zipf_indptr, from_region, beta, snap_km, user_start,
+                    out_day, out_timeslot, out_point, out_lat, out_lng, out_region):
+    """
+    Scalar form of one block of days of simulate: the same draws, user by user and trip by trip.
+    Returns follow row `row` of the returns alias table when `from_region` (through `kernel_cols` if
+    the rows are truncated), otherwise row `user` of the zipf alias table.
+    """
+    for user in range(trips.shape[1]):
+        first, last = region_ptr[user], region_ptr[user + 1]
+        n_jumps = jump_ptr[user + 1] - jump_ptr[user]
+        point_region = region_ids[first:last].max() + 1
+        weights = np.empty(last - first)
+        pos = user_start[user]
+        for day in range(trips.shape[0]):
+            row = home_rows[user]
+            lat, lng = latitudes[row], longitudes[row]
+            at_point = False
+            out_day[pos] = first_day + day
+            out_timeslot[pos] = 0
+            out_lat[pos] = lat
+            out_lng[pos] = lng
+            out_region[pos] = region_ids[row]
+            pos += 1
+
+            for timeslot in range(trips[day, user]):
+                u_explore = uniforms[day, user, 1 + 3 * timeslot]
+                u_jump = uniforms[day, user, 2 + 3 * timeslot]
+                u_return = uniforms[day, user, 3 + 3 * timeslot]
+                out_day[pos] = first_day + day
+                out_timeslot[pos] = timeslot + 1
+
+                if u_explore < p * s[user] ** -gamma:
+                    jump = jump_ptr[user] + int(u_jump * n_jumps)
+                    lat, lng = _latlngshift(lat, lng, jumps[jump, 1], jumps[jump, 0])
+                    s[user] += 1
+                    at_point = True
+                    out_point[pos] = True
+                    out_lat[pos] = lat
+                    out_lng[pos] = lng
+                    out_region[pos] = point_region
+                    pos += 1
+                    continue
+
+                if not from_region:
+                    row = first + _alias_draw(zipf_prob, zipf_alias, zipf_indptr, user, u_return)
+                elif not at_point:
+                    row = first + _transition_draw(returns_prob, returns_alias, returns_indptr, kernel_cols,
+                                                   zipf_prob, zipf_alias, zipf_indptr, row, user, u_return, u_jump)
+                else:
+                    # Return from a point is drawn over all of the user's regions, scaled by distance
+                    nearest, nearest_km, total = first, np.inf, 0.0
+                    for j in range(first, last):
+                        distance_km = _haversine_km(latitudes[j], longitudes[j], lat, lng)
+                        if distance_km < nearest_km:
+                            nearest, nearest_km = j, distance_km
+                        if distance_km > 0:
+                            total += region_probs[j] * np.exp(-beta * distance_km) + 0.0000001
+                        weights[j - first] = total
+                    if 0 <= snap_km and nearest_km <= snap_km:
+                        row = first + _transition_draw(returns_prob, returns_alias, returns_indptr, kernel_cols,
+                                                       zipf_prob, zipf_alias, zipf_indptr, nearest, user,
+                                                       u_return, u_jump)
+                    else:
+                        row = last - 1
+                        for j in range(first, last):
+                            if weights[j - first] > u_return * total:
+                                row = j
+                                break
+                at_point = False
+                lat, lng = latitudes[row], longitudes[row]
+                out_lat[pos] = lat
+                out_lng[pos] = lng
+                out_region[pos] = region_ids[row]
+                pos += 1
+
+
+def draws_per_day(daily_trips_sampling):
+    """
+    Uniform numbers each user draws per simulated day: one for the number of trips
+    and three (explore, jump, return) for each possible trip.
+    """
+    return 1 + 3 * daily_trips_sampling.max_value()
+
+
+def day_streams(seeds, first_day, daily_trips_sampling):
+    """
+    Per-user generators from `seeds`, positioned at the draws of `first_day` so that
+    simulate can continue a run from that day.
+    """
+    rngs = [np.random.default_rng(seed) for seed in seeds]
+    for rng in rngs:
+        # Every uniform double consumes one 64-bit draw of the bit generator
+        rng.bit_generator.advance(first_day * draws_per_day(daily_trips_sampling))
+    return rngs
+
+
+def simulate(store, p, gamma, daily_trips_sampling, n_days, rngs, block_days=20, engine='batch', first_day=0,
+             s=None):
+    """
+    Samples new visits for every user in `store` for `n_days`.
+    All users advance together one trip at a time, so the per-step work is a handful of
+    array operations instead of a model call per user and trip.
+
+    Every user reads a fixed number of uniform numbers per day from its own stream: one for
+    the number of trips and three (explore, jump, return) for each possible trip.
+    The visits of a user therefore only depend on its stream, not on which other users
+    are simulated with it or how the days are split into blocks.
+
+    :param store:
+    UserStore with the fitted state of the users.
+
+    :param p, gamma:
+    Parameters p and gamma in pS^(-gamma).
+
+    :param daily_trips_sampling:
+    How many trips should be sampled every day.
+
+    :param rngs:
+    One np.random.Generator per user in `store`.
+
+    :param block_days:
+    Number of days whose random numbers are drawn at once.
+
+    :param engine:
+    'batch' advances all users together with array operations.
+    'jit' runs the day and trip loop of every user in a kernel compiled with numba, see user_kernel.
+    Both read the same random numbers in the same way.
+
+    :param first_day, s:
+    To continue an earlier run: the first day to simulate, and the per-user s (the number of
+    visited locations) at its start, which is updated in place. The streams in `rngs` must be
+    positioned at `first_day`, see day_streams.
+
+    :return:
+    models.VisitBatch
+    """
+    n_users = store.n_users
+    n_regions = store.n_regions
+    user_rows = store.region_ptr[:-1]
+    n_jumps = np.diff(store.jump_ptr)
+    point_region = np.maximum.reduceat(store.region_ids, user_rows) + 1
+    if s is None:
+        s = n_regions.astype(np.float64)
+    width = draws_per_day(daily_trips_sampling)
+
+    region_alias = AliasTable(store.region_probs, store.region_ptr)
+    if engine == 'jit':
+        returns = region_alias if store.transitions is None else store.transitions
+        kernel_cols = np.zeros(0, dtype=np.int64) if store.kernel_cols is None else store.kernel_cols
+        beta = 0.0 if store.beta is None else store.beta
+        snap_km = -1.0 if store.snap_km is None else store.snap_km
+
+    blocks = []
+    for block_day in range(first_day, first_day + n_days, block_days):
+        days = min(block_days, first_day + n_days - block_day)
+        uniforms = np.stack([rng.random((days, width)) for rng in rngs], axis=1)
+
+        # Every day starts at home followed by the sampled trips; visits are laid out by user, day and timeslot
+        trips = daily_trips_sampling.ppf(uniforms[:, :, 0])
+        counts = trips + 1
+        per_user = counts.sum(axis=0)
+        user_start = np.cumsum(per_user) - per_user
+        day_start = user_start[None, :] + np.cumsum(counts, axis=0) - counts
+
+        total = per_user.sum()
+        out_user = np.repeat(np.arange(n_users), per_user)
+        out_day = np.empty(total, dtype=np.int64)
+        out_timeslot = np.empty(total, dtype=np.int64)
+        out_point = np.zeros(total, dtype=bool)
+        out_lat = np.empty(total, dtype=np.float64)
+        out_lng = np.empty(total, dtype=np.float64)
+        out_region = np.empty(total, dtype=np.int64)
+
+        if engine == 'jit':
+            user_kernel()(block_day, trips, uniforms, s, p, gamma, store.region_ptr, store.latitudes,
+                          store.longitudes, store.region_ids, store.home_rows, store.jump_ptr, store.jumps,
+                          store.region_probs, returns.prob, returns.alias, returns.indptr, kernel_cols,
+                          region_alias.prob, region_alias.alias, region_alias.indptr,
+                          store.transitions is not None, beta, snap_km, user_start,
+                          out_day, out_timeslot, out_point, out_lat, out_lng, out_region)
+        else:
+            for day in range(days):
+                pos = day_start[day]
+                home = store.home_rows
+                out_day[pos] = block_day + day
+                out_timeslot[pos] = 0
+                out_lat[pos] = store.latitudes[home]
+                out_lng[pos] = store.longitudes[home]
+                out_region[pos] = store.region_ids[home]
+
+                cur_row = home.copy()
+                cur_lat = store.latitudes[home].copy()
+                cur_lng = store.longitudes[home].copy()
+                at_point = np.zeros(n_users, dtype=bool)
+
+                for timeslot in range(trips[day].max()):
+                    active = np.flatnonzero(trips[day] > timeslot)
+                    u = uniforms[day, active, 1 + 3 * timeslot:4 + 3 * timeslot]
+                    at = pos[active] + timeslot + 1
+                    out_day[at] = block_day + day
+                    out_timeslot[at] = timeslot + 1
+
+                    explore = u[:, 0] < p * s[active] ** -gamma
+                    users = active[explore]
+                    if users.size > 0:
+                        jump = store.jump_ptr[users] + (u[explore, 1] * n_jumps[users]).astype(np.int64)
+                        lat, lng = models.latlngshift_many(cur_lat[users], cur_lng[users], store.jumps[jump]).T
+                        s[users] += 1
+                        cur_lat[users], cur_lng[users] = lat, lng
+                        at_point[users] = True
+                        out_point[at[explore]] = True
+                        out_lat[at[explore]] = lat
+                        out_lng[at[explore]] = lng
+                        out_region[at[explore]] = point_region[users]
+
+                    returning = ~explore
+                    users = active[returning]
+                    u_return = u[returning, 2]
+                    # The jump number is free on returns and draws the residual of truncated rows
+                    u_residual = u[returning, 1]
+                    rows = np.empty(users.size, dtype=np.int64)
+                    from_point = at_point[users]
+                    if store.transitions is not None:
+                        # Return from a region follows its row of the transition matrix
+                        prev = cur_row[users[~from_point]]
+                        rows[~from_point] = transition_rows(store, prev, u_return[~from_point],
+                                                            u_residual[~from_point], region_alias)
+                        # Return from a point is drawn over all of the user's regions, scaled by distance
+                        point_users = users[from_point]
+                        if point_users.size > 0:
+                            u_point = u_return[from_point]
+                            flat, segment = segment_ranges(user_rows[point_users], n_regions[point_users])
+                            distances_km = haversine_km(store.latitudes[flat], store.longitudes[flat],
+                                                        cur_lat[point_users][segment], cur_lng[point_users][segment])
+                            weights = np.where(distances_km > 0,
+                                               store.region_probs[flat] * np.exp(-store.beta * distances_km) + 0.0000001,
+                                               0)
+                            picks = segment_choice(weights, n_regions[point_users], u_point)
+                            if store.snap_km is not None:
+                                nearest = segment_argmin(distances_km, n_regions[point_users])
+                                snapped = np.flatnonzero(distances_km[nearest] <= store.snap_km)
+                                snapped_rows = transition_rows(store, flat[nearest[snapped]], u_point[snapped],
+                                                               u_residual[from_point][snapped], region_alias)
+                                segment_start = np.cumsum(n_regions[point_users]) - n_regions[point_users]
+                                picks[snapped] = segment_start[snapped] + snapped_rows - user_rows[point_users[snapped]]
+                            rows[from_point] = flat[picks]
+                    else:
+                        cols = region_alias.draw(users, u_return)
+                        rows[:] = user_rows[users] + cols
+
+                    cur_row[users] = rows
+                    cur_lat[users] = store.latitudes[rows]
+                    cur_lng[users] = store.longitudes[rows]
+                    at_point[users] = False
+                    out_lat[at[returning]] = cur_lat[users]
+                    out_lng[at[returning]] = cur_lng[users]
+                    out_region[at[returning]] = store.region_ids[rows]
+
+        blocks.append((out_user, out_day, out_timeslot, out_point, out_lat, out_lng, out_region))
+
+    out_user, out_day, out_timeslot, out_point, out_lat, out_lng, out_region = \
+        [np.concatenate(columns) for columns in zip(*blocks)]
+    # Blocks are in day order, so a stable sort by user restores the user, day, timeslot order
+    order = np.argsort(out_user, kind='stable')
+    return models.VisitBatch(
+        userid=store.userids.values[out_user[order]],
+        day=out_day[order],
+        timeslot=out_timeslot[order],
+        kind=out_point[order],
+        latitude=out_lat[order],
+        longitude=out_lng[order],
+        region=out_region[order],
+    )
+
+
+def visit_users(visits):
+    """
+    Position of the user of every visit, for visits grouped by user (as returned by simulate).
+    """
+    changes = visits.userid[1:] != visits.userid[:-1]
+    return np.concatenate([[0], np.cumsum(changes)]).astype(np.int64)
+
+
+def visit_trips(store, visits, region_zones, zones, last_zones=None):
+    """
+    Trips between consecutive visits of each user by zone, without building a visits DataFrame.
+    Like aligned_visits_to_odm, visits outside every zone are skipped, so a trip connects
+    the visits before and after them.
+
+    :param store:
+    UserStore the visits were simulated from.
+
+    :param visits:
+    models.VisitBatch from simulate.
+
+    :param region_zones:
+    Zone code (position in `zones`, -1 if none) of every region row of `store`.
+
+    :param zones:
+    GeoDataFrame [zone, geometry], or its genericvalidation.ZoneIndex to look up points without rebuilding it.
+
+    :param last_zones:
+    Optional. When counting a run block by block, the zone of every user's last visit in a zone
+    in the previous blocks (-1 for none). The first trip of the block starts there, and the
+    array is updated in place for the next block.
+
+    :return:
+    Position in `store` of the user of every trip, and its key origin * n_zones + destination.
+    """
+    n_zones = len(zones)
+    users = visit_users(visits)
+    codes = np.full(len(visits), -1, dtype=np.int64)
+
+    # Regions are mapped with the zones of the user's region rows, points one by one
+    regional = np.flatnonzero(visits.kind == 0)
+    stride = np.int64(store.region_ids.max()) + 2
+    row_keys = np.repeat(np.arange(store.n_users), store.n_regions) * stride + store.region_ids
+    rows = np.searchsorted(row_keys, users[regional] * stride + visits.region[regional])
+    codes[regional] = region_zones[rows]
+    points = np.flatnonzero(visits.kind == 1)
+    if points.size > 0:
+        codes[points] = genericvalidation.zone_codes(visits.latitude[points], visits.longitude[points], zones)
+
+    if last_zones is not None:
+        # Each user's last zone goes in front of its visits of this block
+        starts = np.flatnonzero(np.concatenate([[True], users[1:] != users[:-1]]))
+        codes = np.insert(codes, starts, last_zones)
+        users = np.insert(users, starts, np.arange(store.n_users))
+
+    aligned = np.flatnonzero(codes >= 0)
+    trips = users[aligned[1:]] == users[aligned[:-1]]
+    keys = codes[aligned[:-1]][trips] * n_zones + codes[aligned[1:]][trips]
+    if last_zones is not None:
+        is_last = np.concatenate([~trips, [True]]) if aligned.size > 0 else np.zeros(0, dtype=bool)
+        last_zones[users[aligned[is_last]]] = codes[aligned[is_last]]
+    return users[aligned[1:]][trips], keys
+
+
+def visits_to_partial_odm(store, visits, region_zones, zones, weights=None, last_zones=None):
+    """
+    Counts the trips between consecutive visits of each user by zone, see visit_trips.
+
+    :param weights:
+    Optional weight of every user in `store`.
+
+    :return:
+    Sparse ODM as (keys, counts) with keys origin * n_zones + destination.
+    """
+    users, keys = visit_trips(store, visits, region_zones, zones, last_zones=last_zones)
+    trip_weights = None if weights is None else weights[users]
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=trip_weights, minlength=keys.shape[0]).astype(np.float64)
+
+
+def visits_to_user_odm(store, visits, region_zones, zones):
+    """
+    Counts the trips of every user separately, see visit_trips.
+
+    :return:
+    scipy.sparse.csr_matrix of shape (n_users, n_zones * n_zones), one row of trip counts
+    per user of `store`, with columns origin * n_zones + destination.
+    """
+    n_zones = len(zones)
+    users, keys = visit_trips(store, visits, region_zones, zones)
+    odm = sparse.csr_matrix((np.ones(keys.shape[0]), (users, keys)), shape=(store.n_users, n_zones * n_zones))
+    odm.sum_duplicates()
+    return odm
+
+
+# Per-user data of every live SimulationExecutor, keyed by executor.
+# Workers see it either through fork or through the pool initializer.
+_executor_shards = {}
+_executor_zones = {}
+_executor_keys = itertools.count()
+# Store of the worker refitted for the beta of the current evaluation, keyed by (executor, shard)
+_worker_stores = {}
+
+
+def _init_executor_worker(key, shards, zones):
+    _executor_shards[key] = shards
+    _executor_zones[key] = zones
+
+
+def _shard_store(key, shard, beta):
+    cached = _worker_stores.get((key, shard))
+    if cached is None or cached[0] != beta:
+        base = _executor_shards[key][shard]
+        cached = (beta, base if base.beta == beta else base.refit(beta))
+        _worker_stores[(key, shard)] = cached
+    return cached[1]
+
+
+def _simulate_shard(key, shard, p, gamma, beta, days, daily_trips_sampling, seeds, engine,
+                    estimator=None, weights=None):
+    store = _shard_store(key, shard, beta)
+    rngs = [np.random.default_rng(seed) for seed in seeds]
+    visits = simulate(store, p, gamma, daily_trips_sampling, days, rngs, engine=engine)
+    if estimator is None:
+        return visits
+    zones, region_zones = _executor_zones[key]
+    if estimator == 'user':
+        return visits_to_user_odm(store, visits, region_zones[shard], zones)
+    return visits_to_partial_odm(store, visits, region_zones[shard], zones, weights)
+
+
+def _advance_shard(key, shard, p, gamma, beta, first_day, days, daily_trips_sampling, seeds, engine,
+                   state=None, weights=None):
+    store = _shard_store(key, shard, beta)
+    if state is None:
+        state = (store.n_regions.astype(np.float64), np.full(store.n_users, -1, dtype=np.int64))
+    s, last_zones = state[0].copy(), state[1].copy()
+    rngs = day_streams(seeds, first_day, daily_trips_sampling)
+    visits = simulate(store, p, gamma, daily_trips_sampling, days, rngs, engine=engine, first_day=first_day, s=s)
+    zones, region_zones = _executor_zones[key]
+    keys, counts = visits_to_partial_odm(store, visits, region_zones[shard], zones, weights, last_zones=last_zones)
+    return keys, counts, (s, last_zones)
+
+
+class SimulationExecutor:
+    """
+    A long-lived pool of worker processes that keeps a region's users, fitted once into a UserStore
+    and split into shards, in the workers.
+    Every evaluation then only sends (p, gamma, beta, days) to the workers, instead of
+    starting a pool and shipping the tweets each time.
+
+    :param tweets:
+    pd.DataFrame (userid*, region, label, latitude, longitude, ...rest))
+
+    :param store:
+    A UserStore fitted with RegionTransitionZipf, e.g. from UserStore.load, instead of `tweets`.
+
+    :param daily_trips_sampling:
+    How many trips should be sampled every day.
+
+    :param zipfs:
+    Parameter of the zipf region probabilities in RegionTransitionZipf. Not used with a store.
+
+    :param processes:
+    Number of worker processes. Defaults to the number of CPUs.
+
+    :param zones:
+    Optional. GeoDataFrame [zone, geometry] for `evaluate_odm`. The regions of every user
+    are mapped to zones once here, and a genericvalidation.ZoneIndex is built for the explored points.
+
+    :param engine:
+    'batch' or 'jit', see simulate.
+
+    :param top_k:
+    Optional. Truncates the transition rows of users with many regions, see truncated_kernels.
+    Not used with a store.
+
+    :param zone_index:
+    Optional genericvalidation.ZoneIndex of `zones`, built here if not given.
+    """
+
+    def __init__(self, tweets=None, daily_trips_sampling=None, zipfs=1.2, processes=None, zones=None,
+                 engine='batch', store=None, top_k=None, zone_index=None):
+        if tweets is None and store is None:
+            raise Exception("tweets or store must be set")
+        if daily_trips_sampling is None:
+            daily_trips_sampling = models.WeightedDistribution()
+        self.daily_trips_sampling = daily_trips_sampling
+        self.zipfs = zipfs
+        if engine not in ('batch', 'jit'):
+            raise Exception("engine must be 'batch' or 'jit'")
+        self.engine = engine
+        self.processes = mp.cpu_count() if processes is None else processes
+
+        if store is None:
+            if not tweets.index.is_monotonic_increasing:
+                tweets = tweets.sort_index(kind='stable')
+            store = UserStore.from_tweets(tweets, zipfs=zipfs, top_k=top_k)
+        # A few contiguous blocks of users per process to balance the load
+        blocks = [b for b in np.array_split(np.arange(store.n_users), 4 * self.processes) if len(b) > 0]
+        shards = [store.take(b[0], b[-1] + 1) for b in blocks]
+        self.n_shards = len(shards)
+        self.n_users = store.n_users
+        self.shard_users = [(b[0], b[-1] + 1) for b in blocks]
+        self.shard_userids = [shard.userids.values for shard in shards]
+
+        self.zones = zones
+        zone_state = None
+        if zones is not None:
+            # Workers look up the zones of explored points in one shared index
+            if zone_index is None:
+                zone_index = genericvalidation.ZoneIndex(zones)
+            region_zones = [zone_index.lookup_lonlat(shard.latitudes, shard.longitudes) for shard in shards]
+            zone_state = (zone_index, region_zones)
+
+        self.key = next(_executor_keys)
+        if 'fork' in mp.get_all_start_methods():
+            # Forked workers inherit the shards without copying them
+            _executor_shards[self.key] = shards
+            _executor_zones[self.key] = zone_state
+            self.pool = mp.get_context('fork').Pool(self.processes)
+        else:
+            self.pool = mp.Pool(self.processes, initializer=_init_executor_worker,
+                                initargs=(self.key, shards, zone_state))
+
+    def describe(self):
+        return {
+            "type": "executor",
+            "processes": self.processes,
+            "n_shards": self.n_shards,
+            "zipfs": self.zipfs,
+            "engine": self.engine,
+            "daily_trips_sampling": self.daily_trips_sampling.describe(),
+        }
+
+    def evaluate(self, p=None, gamma=None, beta=None, days=None, seed=None):
+        """
+        Samples new visits for all users for one set of parameters.
+
+        :param seed:
+        Seed of the per-user random streams. The same seed gives the same visits
+        regardless of the number of processes. Defaults to fresh entropy.
+
+        :return:
+        pd.DataFrame (userid*, day, timeslot, kind, latitude, longitude, region)
+        """
+        seeds = np.random.SeedSequence(seed).spawn(self.n_users)
+        samples_list = self.pool.starmap(
+            _simulate_shard,
+            [(self.key, shard, p, gamma, beta, days, self.daily_trips_sampling, seeds[first:last],
+              self.engine)
+             for shard, (first, last) in enumerate(self.shard_users)],
+        )
+        return models.VisitBatch.concat(samples_list).to_frame()
+
+    def evaluate_odm(self, p=None, gamma=None, beta=None, days=None, seed=None, weights=None):
+        """
+        Simulates all users for one set of parameters and returns only their ODM.
+        Every worker counts the trips of its users between zones and sends back a sparse
+        partial ODM, so the visits are never collected. Needs `zones`.
+
+        :param weights:
+        Optional pd.Series of user weights indexed by userid. Users without a weight are left out,
+        like the inner merge with the home locations in VisitsGeneration.visits_gen.
+
+        :return:
+        Normalized genericvalidation.SparseODM, as from genericvalidation.visits_to_odm.
+        """
+        if self.zones is None:
+            raise Exception("zones must be set for evaluate_odm")
+        seeds = np.random.SeedSequence(seed).spawn(self.n_users)
+        partials = self.pool.starmap(
+            _simulate_shard,
+            [(self.key, shard, p, gamma, beta, days, self.daily_trips_sampling, seeds[first:last],
+              self.engine, 'sample', None if weights is None else weights.reindex(userids).fillna(0).values.astype(np.float64))
+             for shard, ((first, last), userids) in enumerate(zip(self.shard_users, self.shard_userids))],
+        )
+        keys = np.concatenate([k for k, _ in partials])
+        counts = np.concatenate([c for _, c in partials])
+        return genericvalidation.sparse_to_odm(keys, counts, self.zones)
+
+    def evaluate_user_odm(self, p=None, gamma=None, beta=None, days=None, seed=None):
+        """
+        Simulates all users for one set of parameters and keeps the trips of every user apart,
+        so the ODM of any subset of users can be summed later without simulating again. Needs `zones`.
+
+        :return:
+        genericvalidation.UserODM
+        """
+        if self.zones is None:
+            raise Exception("zones must be set for evaluate_user_odm")
+        seeds = np.random.SeedSequence(seed).spawn(self.n_users)
+        partials = self.pool.starmap(
+            _simulate_shard,
+            [(self.key, shard, p, gamma, beta, days, self.daily_trips_sampling, seeds[first:last],
+              self.engine, 'user')
+             for shard, (first, last) in enumerate(self.shard_users)],
+        )
+        return genericvalidation.UserODM(
+            matrix=sparse.vstack(partials, format='csr'),
+            userids=np.concatenate(self.shard_userids),
+            zones=self.zones,
+        )
+
+    def iter_odm(self, p=None, gamma=None, beta=None, checkpoints=None, seed=None, weights=None):
+        """
+        Simulates all users once up to the last of `checkpoints` (in days), block by block,
+        and yields the cumulative ODM at every checkpoint. Every worker carries the state of its users
+        (s, random streams and last zone) from one block to the next, so the ODM after D days is the
+        one of an independent run of D days with the same seed. Needs `zones`.
+
+        :param checkpoints:
+        Increasing numbers of days.
+
+        :param weights:
+        Optional pd.Series of user weights indexed by userid, see evaluate_odm.
+
+        :return:
+        Generator of (days, normalized genericvalidation.SparseODM as from evaluate_odm).
+        """
+        if self.zones is None:
+            raise Exception("zones must be set for iter_odm")
+        seeds = np.random.SeedSequence(seed).spawn(self.n_users)
+        shard_weights = [None if weights is None else weights.reindex(userids).fillna(0).values.astype(np.float64)
+                         for userids in self.shard_userids]
+        states = [None] * self.n_shards
+        odm = genericvalidation.SparseODM(keys=[], zones=self.zones)
+        first_day = 0
+        for days in checkpoints:
+            results = self.pool.starmap(
+                _advance_shard,
+                [(self.key, shard, p, gamma, beta, first_day, days - first_day, self.daily_trips_sampling,
+                  seeds[first:last], self.engine, states[shard], shard_weights[shard])
+                 for shard, (first, last) in enumerate(self.shard_users)],
+            )
+            odm = odm + genericvalidation.SparseODM(keys=np.concatenate([keys for keys, _, _ in results]),
+                                                     values=np.concatenate([counts for _, counts, _ in results]),
+                                                     zones=self.zones)
+            states = [state for _, _, state in results]
+            first_day = days
+            yield days, odm.normalize()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        _executor_shards.pop(self.key, None)
+        _executor_zones.pop(self.key, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -2,6 +2,7 @@ import geopandas as gpd
 import pandas as pd
 import os
 import subprocess
+import lib.genericvalidation as genericvalidation
 
 
 def get_repo_root():
@@ -49,10 +50,7 @@ class GroundTruthLoader:
         # Prepare ODM
         odms = trips.groupby(['origin_main_deso', 'desti_main_deso']).sum()['trip_weight']
         print(odms.head())
-        z = self.zones.zone
-        odms = odms.reindex(pd.MultiIndex.from_product([z, z], names=['ozone', 'dzone']), fill_value=0)
-        print(odms.head())
-        self.odm = odms / odms.sum()
+        self.odm = genericvalidation.SparseODM.from_series(odms, self.zones).normalize()
 
         # Prepare the actual trip distances
         self.trip_distances = trips.loc[:,
@@ -1,5 +1,7 @@
 import pandas as pd
 import numpy as np
+from scipy import sparse
+import lib.genericvalidation as genericvalidation
 
 
 class DistanceMetrics:
@@ -9,21 +11,66 @@ class DistanceMetrics:
     def compute(self, quantile_groups=None, odms=None, titles=None):
         """
         :param quantile_groups:
-        pd.SeriesGroupby mapping distance groups to indexes.
+        genericvalidation.DistanceBins, or pd.SeriesGroupby mapping distance groups to indexes.
         Obtained by Sampers.prepare
+
+        :param odms:
+        List of genericvalidation.SparseODM, or of pd.Series over all pairs of zones in the order of quantile_groups.
         """
         if len(odms) != len(titles):
             raise Exception("odms and titles must have same length")
-        metrics = []
-        for grpkey in quantile_groups.groups:
-            odm_grps = [o.iloc[quantile_groups.indices[grpkey]] for o in odms]
-            metrics.append(
-                [grpkey] + [g.sum() for g in odm_grps]
-            )
+        sums = self.distance_sums(quantile_groups, odms)
         return pd.DataFrame(
-            metrics,
-            columns=['distance'] + [t + '_sum' for t in titles]
-        ).set_index('distance')
+            sums.T,
+            columns=[t + '_sum' for t in titles],
+            index=pd.Index(self.groups(quantile_groups), name='distance')
+        )
+
+    def groups(self, quantile_groups=None):
+        """Labels of the distance groups."""
+        if isinstance(quantile_groups, genericvalidation.DistanceBins):
+            return quantile_groups.labels
+        return list(quantile_groups.groups)
+
+    def distance_sums(self, quantile_groups=None, odms=None):
+        """
+        Sums every ODM of a stack (replicates, parameter sets, subsets of users...) by distance group
+        with a single bincount, the ODM k being counted in bins k * n_groups + group.
+
+        :param odms:
+        List of ODMs as for compute, or a scipy.sparse matrix with one ODM over all pairs of zones per row.
+
+        :return:
+        (n_odms, n_groups) array
+        """
+        if isinstance(quantile_groups, genericvalidation.DistanceBins):
+            codes = quantile_groups.codes
+        else:
+            codes = genericvalidation.distance_group_codes(quantile_groups)
+        n_groups = len(self.groups(quantile_groups))
+        if sparse.issparse(odms):
+            stack = odms.tocoo()
+            rows, keys, values = stack.row, stack.col, stack.data
+            n_odms = stack.shape[0]
+        else:
+            rows, keys, values = [], [], []
+            for k, odm in enumerate(odms):
+                if isinstance(odm, genericvalidation.SparseODM):
+                    odm_keys, odm_values = odm.keys, odm.values
+                else:
+                    odm_values = np.asarray(odm.values, dtype=np.float64)
+                    odm_keys = np.flatnonzero(odm_values)
+                    odm_values = odm_values[odm_keys]
+                rows.append(np.full(odm_keys.shape[0], k))
+                keys.append(odm_keys)
+                values.append(odm_values)
+            n_odms = len(odms)
+            rows, keys, values = np.concatenate(rows), np.concatenate(keys), np.concatenate(values)
+        groups = np.asarray(codes)[keys].astype(np.int64)
+        grouped = groups >= 0
+        sums = np.bincount(rows[grouped] * n_groups + groups[grouped], weights=values[grouped],
+                           minlength=n_odms * n_groups)
+        return sums.reshape(n_odms, n_groups)
 
     def kullback_leibler(self, distances, titles=None):
         """
@@ -37,6 +37,7 @@ class RegionParaGenerate:
         self.rg = rg
         self.visits = visits
         self.odm_gt = None
+        self.user_odm = None
 
     def region_data_load(self, type='calibration'):
         if '-' not in self.region:
@@ -50,13 +51,12 @@ class RegionParaGenerate:
         self.rg = rg_
         # Assign odm_gt for later comparison
         if self.odm_gt is None:
-            self.odm_gt = self.rg.gt_odm.copy()
-            self.odm_gt = self.odm_gt.reset_index()
-            self.odm_gt.columns = ['ozone', 'dzone', 'gt']
+            self.odm_gt = self.rg.gt_odm.to_frame('gt')
         self.visits = gs_model.VisitsGeneration(region=self.region, bbox=self.rg.bbox,
                                                 zones=self.rg.zones, odm=self.rg.gt_odm,
-                                                distances=self.rg.distances,
-                                                distance_quantiles=self.rg.distance_quantiles, gt_dms=self.rg.dms)
+                                                distance_bins=self.rg.distance_bins, gt_dms=self.rg.dms,
+                                                zone_index=self.rg.zone_index,
+                                                context=self.rg.evaluation_context(type=type))
 
     def visits_gen_by_nmax(self, type='calibration', p=None, gamma=None, beta=None, N_max=None):
         if type == 'calibration':
@@ -77,8 +77,7 @@ class RegionParaGenerate:
         dms, _, model_odm = self.visits.visits2measure(visits=visits_total, home_locations=self.rg.home_locations)
         kl = validation.DistanceMetrics().kullback_leibler(dms, titles=['groundtruth', 'model'])
         # SSI
-        model_odm = model_odm.reset_index()
-        model_odm.columns = ['ozone', 'dzone', 'model']
+        model_odm = model_odm.to_frame('model')
         df = pd.merge(self.odm_gt, model_odm, on=['ozone', 'dzone'])
         ssi = hp.ssi_dataframe(df, var1='gt', var2='model')
         print("N_max=", N_max, " kl=", kl, " ssi=", ssi)
@@ -89,21 +88,19 @@ class RegionParaGenerate:
             tweets = self.rg.tweets_calibration
         else:
             tweets = self.rg.tweets_validation
-        # Downsample all Twitter users' data to N_max if needed
-        if indi_list is not None:
-            tweets = tweets.loc[tweets.index.isin(indi_list), :]
-            # Remove users with only one region
-            regioncount = tweets.groupby(['userid', 'region']).size().groupby('userid').size()
-            tweets = tweets.drop(labels=regioncount[regioncount < 2].index)
-        n_total = len(tweets)
-        # userid as index for visits_total
-        visits_total = self.visits.visits_gen(tweets, p, gamma, beta,
-                                              days=260, homelocations=self.rg.home_locations)
-        dms, _, model_odm = self.visits.visits2measure(visits=visits_total, home_locations=self.rg.home_locations)
-        kl = validation.DistanceMetrics().kullback_leibler(dms, titles=['groundtruth', 'model'])
+        # Remove users with only one region
+        regioncount = tweets.groupby(['userid', 'region']).size().groupby('userid').size()
+        tweets = tweets.drop(labels=regioncount[regioncount < 2].index)
+        # Simulate all users once and keep their trips apart, each subset is then a sum of their rows
+        if self.user_odm is None or self.user_odm[0] != (type, p, gamma, beta):
+            self.user_odm = ((type, p, gamma, beta), self.visits.user_odm_gen(tweets, p, gamma, beta, days=260))
+        if indi_list is None:
+            indi_list = tweets.index.unique()
+        n_total = tweets.index.isin(indi_list).sum()
+        dms, kl, model_odm = self.visits.subset2measure(self.user_odm[1], userids=indi_list,
+                                                        homelocations=self.rg.home_locations)
         # SSI
-        model_odm = model_odm.reset_index()
-        model_odm.columns = ['ozone', 'dzone', 'model']
+        model_odm = model_odm.to_frame('model')
         df = pd.merge(self.odm_gt, model_odm, on=['ozone', 'dzone'])
         ssi = hp.ssi_dataframe(df, var1='gt', var2='model')
         print("# of users=", len(indi_list), " kl=", kl, " ssi=", ssi)
@@ -0,0 +1,87 @@
+import sys
+import subprocess
+import os
+
+
+def get_repo_root():
+    """Get the root directory of the repo."""
+    dir_in_repo = os.path.dirname(os.path.abspath('__file__'))
+    return subprocess.check_output('git rev-parse --show-toplevel'.split(),
+                                   cwd=dir_in_repo,
+                                   universal_newlines=True).rstrip()
+
+
+ROOT_dir = get_repo_root()
+sys.path.append(ROOT_dir)
+sys.path.insert(0, ROOT_dir + '/lib')
+
+import time
+import numpy as np
+import pandas as pd
+import lib.gs_model as gs_model
+import lib.helpers as helpers
+import lib.models as models
+
+
+def load_tweets(region=None, n_users=None):
+    """Calibration tweets of the first `n_users` users, filtered like RegionDataPrep.load_geotweets."""
+    geotweets = helpers.read_geotweets_raw(gs_model.region_path[region]['tweets_calibration']).set_index('userid')
+    geotweets = geotweets[(geotweets['weekday'] < 6) & (0 < geotweets['weekday'])]
+    home_visits = geotweets.query("label == 'home'").groupby('userid').size()
+    geotweets = geotweets.loc[home_visits.index]
+    tweetcount = geotweets.groupby('userid').size()
+    geotweets = geotweets.drop(labels=tweetcount[tweetcount < 20].index)
+    regioncount = geotweets.groupby(['userid', 'region']).size().groupby('userid').size()
+    geotweets = geotweets.drop(labels=regioncount[regioncount < 2].index)
+    geotweets = geotweets.sort_values(by=['userid', 'createdat']).drop(columns=['geometry'], errors='ignore')
+    users = geotweets.index.unique()[:n_users]
+    return geotweets.loc[users]
+
+
+def summary(visits):
+    """Statistics that should agree between engines up to sampling noise."""
+    trips = visits[visits.timeslot > 0]
+    returns = trips[trips.kind == 'region']
+    home = visits[visits.timeslot == 0].groupby(level=0).region.first()
+    return {
+        'visits': len(visits),
+        'trips per day': len(trips) / visits.groupby([visits.index, 'day']).ngroups,
+        'exploration share': (trips.kind == 'point').mean(),
+        'home return share': (returns.region.values == home.reindex(returns.index).values).mean(),
+        'regions per user': returns.groupby(level=0).region.nunique().mean(),
+    }
+
+
+if __name__ == '__main__':
+    region = sys.argv[1] if len(sys.argv) > 1 else 'netherlands'
+    n_users = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    days = int(sys.argv[3]) if len(sys.argv) > 3 else 260
+    tweets = load_tweets(region=region, n_users=n_users)
+    print(region, tweets.index.nunique(), "users,", days, "days")
+
+    results, samples = {}, {}
+    for engine in ['loop', 'batch', 'jit']:
+        sampler = models.Sampler(
+            model=models.PreferentialReturn(
+                p=0.5,
+                gamma=0.3,
+                region_sampling=models.RegionTransitionZipf(beta=0.3, zipfs=1.2)
+            ),
+            n_days=days,
+            daily_trips_sampling=models.WeightedDistribution(),
+            engine=engine,
+            seed=0,
+        )
+        if engine == 'jit':
+            # Compile the kernel before timing
+            sampler.sample_batch(tweets.loc[tweets.index.unique()[:1]])
+        start_time = time.time()
+        visits = sampler.sample(tweets)
+        elapsed = time.time() - start_time
+        results[engine] = dict(summary(visits), seconds=elapsed)
+        samples[engine] = visits
+    # Both array engines read the same random numbers, so their visits should match exactly
+    same = np.array_equal(samples['jit'].region.values, samples['batch'].region.values) and \
+        np.allclose(samples['jit'].latitude.values, samples['batch'].latitude.values)
+    print("jit and batch visits identical:", same)
+    print(pd.DataFrame(results).round(4))
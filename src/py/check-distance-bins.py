@@ -0,0 +1,47 @@
+import sys
+import subprocess
+import os
+
+
+def get_repo_root():
+    """Get the root directory of the repo."""
+    dir_in_repo = os.path.dirname(os.path.abspath('__file__'))
+    return subprocess.check_output('git rev-parse --show-toplevel'.split(),
+                                   cwd=dir_in_repo,
+                                   universal_newlines=True).rstrip()
+
+
+ROOT_dir = get_repo_root()
+sys.path.append(ROOT_dir)
+sys.path.insert(0, ROOT_dir + '/lib')
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import box
+import lib.genericvalidation as genericvalidation
+
+
+def clustered_zones(n_clusters=4, per_cluster=30, size_m=100, seed=0):
+    """Zones stacked on a few spots of a few clusters, so that many pairs share the same distance."""
+    rng = np.random.default_rng(seed)
+    corners = [(300000 + c * 50000 + rng.integers(0, 3) * 2000, 6380000 + c * 20000 + rng.integers(0, 3) * 2000)
+               for c in range(n_clusters) for _ in range(per_cluster)]
+    geoms = [box(x, y, x + size_m, y + size_m) for x, y in corners]
+    return gpd.GeoDataFrame({'zone': [str(k) for k in range(len(geoms))]}, geometry=geoms, crs="EPSG:3006")
+
+
+if __name__ == '__main__':
+    zones = clustered_zones()
+    # The groups of all pairs are those of pd.qcut with the repeated quantiles dropped
+    bins = genericvalidation.DistanceBins.compute(zones)
+    quantiles = pd.qcut(genericvalidation.zone_distances(zones).values, q=100, duplicates='drop')
+    assert np.array_equal(bins.codes, quantiles.codes)
+    assert bins.labels.equals(quantiles.categories)
+    print(bins.n_groups, "groups from all pairs, as pd.qcut")
+
+    # Sampled quantiles repeat as well
+    bins = genericvalidation.DistanceBins.compute(zones, sample=500)
+    assert (np.diff(bins.edges) > 0).all() and len(bins.labels) == bins.n_groups
+    assert bins.codes.max() < bins.n_groups
+    print(bins.n_groups, "groups from sampled pairs")
@@ -0,0 +1,74 @@
+import sys
+import subprocess
+import os
+
+
+def get_repo_root():
+    """Get the root directory of the repo."""
+    dir_in_repo = os.path.dirname(os.path.abspath('__file__'))
+    return subprocess.check_output('git rev-parse --show-toplevel'.split(),
+                                   cwd=dir_in_repo,
+                                   universal_newlines=True).rstrip()
+
+
+ROOT_dir = get_repo_root()
+sys.path.append(ROOT_dir)
+sys.path.insert(0, ROOT_dir + '/lib')
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import box
+import lib.gs_model as gs_model
+import lib.simulation as simulation
+import lib.genericvalidation as genericvalidation
+
+
+def grid_zones(size_m=10000, n=20):
+    """n x n square zones around Gothenburg in SWEREF99 TM."""
+    geoms = [box(300000 + i * size_m, 6350000 + j * size_m, 300000 + (i + 1) * size_m, 6350000 + (j + 1) * size_m)
+             for i in range(n) for j in range(n)]
+    return gpd.GeoDataFrame({'zone': [str(k) for k in range(len(geoms))]}, geometry=geoms, crs="EPSG:3006")
+
+
+def synthetic_tweets(n_users=60, seed=0):
+    """Tweets of users with a few regions each around Gothenburg, region 0 being home."""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for userid in range(n_users):
+        n_regions = rng.integers(2, 10)
+        centres = np.array([57.7, 11.9]) + rng.normal(0, 0.3, 2) + rng.normal(0, 0.05, (n_regions, 2))
+        n_tweets = rng.integers(25, 60)
+        probs = 1 / np.arange(1, n_regions + 1)
+        regions = rng.choice(n_regions, size=n_tweets, p=probs / probs.sum())
+        regions[:2] = [0, 1]
+        frames.append(pd.DataFrame({
+            'userid': userid,
+            'region': regions,
+            'latitude': centres[regions, 0],
+            'longitude': centres[regions, 1],
+            'createdat': pd.Timestamp('2019-01-01') +
+            pd.to_timedelta(np.sort(rng.integers(0, 3600 * 24 * 200, n_tweets)), unit='s'),
+            'label': np.where(regions == 0, 'home', 'other'),
+        }))
+    return pd.concat(frames).set_index('userid')
+
+
+if __name__ == '__main__':
+    zones = grid_zones()
+    tweets = synthetic_tweets()
+    users = tweets.index.unique()
+    # Some users without a weight, who are left out like in the merge of VisitsGeneration.visits_gen
+    weights = pd.Series(np.random.default_rng(1).uniform(0.1, 5, len(users)), index=users).iloc[5:]
+
+    with simulation.SimulationExecutor(tweets=tweets, zones=zones, processes=2) as executor:
+        fused = executor.evaluate_odm(p=0.6, gamma=0.3, beta=0.3, days=20, seed=3, weights=weights)
+        visits = executor.evaluate(p=0.6, gamma=0.3, beta=0.3, days=20, seed=3)
+    visits = pd.merge(visits, weights.to_frame('weight'), left_index=True, right_index=True)
+    aligned = genericvalidation.visits_to_odm(visits, zones)
+    context = gs_model.EvaluationContext(region='netherlands', tweets=tweets, zones=zones).odm(visits)
+
+    for name, odm in [('visits_to_odm', aligned), ('EvaluationContext.odm', context)]:
+        assert np.array_equal(odm.keys, fused.keys), name
+        assert np.allclose(odm.values, fused.values), name
+        print(name, "matches evaluate_odm, max difference", np.abs(odm.values - fused.values).max())
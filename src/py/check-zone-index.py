@@ -0,0 +1,49 @@
+import sys
+import subprocess
+import os
+
+
+def get_repo_root():
+    """Get the root directory of the repo."""
+    dir_in_repo = os.path.dirname(os.path.abspath('__file__'))
+    return subprocess.check_output('git rev-parse --show-toplevel'.split(),
+                                   cwd=dir_in_repo,
+                                   universal_newlines=True).rstrip()
+
+
+ROOT_dir = get_repo_root()
+sys.path.append(ROOT_dir)
+sys.path.insert(0, ROOT_dir + '/lib')
+
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import box
+import lib.genericvalidation as genericvalidation
+
+
+def grid_zones(size_m=10000, n=20):
+    """n x n square zones around Gothenburg in SWEREF99 TM, with every fifth zone left out."""
+    geoms = [box(300000 + i * size_m, 6380000 + j * size_m, 300000 + (i + 1) * size_m, 6380000 + (j + 1) * size_m)
+             for i in range(n) for j in range(n) if (i * n + j) % 5 != 0]
+    return gpd.GeoDataFrame({'zone': [str(k) for k in range(len(geoms))]}, geometry=geoms, crs="EPSG:3006")
+
+
+if __name__ == '__main__':
+    zones = grid_zones()
+    rng = np.random.default_rng(0)
+    x = rng.uniform(290000, 510000, 20000)
+    y = rng.uniform(6370000, 6590000, 20000)
+    points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(x, y), crs=zones.crs)
+    joined = gpd.sjoin(points, zones[['geometry']].reset_index(drop=True), predicate='intersects')
+    expected = np.full(x.shape[0], -1)
+    joined = joined.reset_index().sort_values(['index', 'index_right']).drop_duplicates('index')
+    expected[joined['index'].values] = joined.index_right.values
+
+    for max_cells in [0, 2 ** 16]:
+        zone_index = genericvalidation.ZoneIndex(zones, max_cells=max_cells)
+        # Points outside every zone only, then some of them outside
+        assert (zone_index.lookup(np.array([0.0]), np.array([0.0])) == -1).all()
+        assert (zone_index.lookup(np.array([305000.0]), np.array([6385000.0])) == -1).all()
+        assert np.array_equal(zone_index.lookup(x, y), expected)
+        assert zone_index.lookup(np.array([]), np.array([])).shape == (0,)
+        print("max_cells", max_cells, "matches sjoin,", (expected == -1).sum(), "points outside all zones")
@@ -17,9 +17,9 @@ sys.path.append(ROOT_dir)
 sys.path.insert(0, ROOT_dir + '/lib')
 
 import lib.gs_model as gs_model
+import lib.simulation as simulation
 import time
 import json
-import lib.validation as validation
 
 
 class RegionParaGenerate:
@@ -28,6 +28,7 @@ class RegionParaGenerate:
         self.region = region
         self.rg = rg
         self.visits = visits
+        self.executor = None
 
     def region_data_load(self, type='calibration'):
         if '-' not in self.region:
@@ -41,21 +42,31 @@ class RegionParaGenerate:
         self.rg = rg_
         self.visits = gs_model.VisitsGeneration(region=self.region, bbox=self.rg.bbox,
                                                 zones=self.rg.zones, odm=self.rg.gt_odm,
-                                                distances=self.rg.distances,
-                                                distance_quantiles=self.rg.distance_quantiles, gt_dms=self.rg.dms)
+                                                distance_bins=self.rg.distance_bins, gt_dms=self.rg.dms,
+                                                zone_index=self.rg.zone_index,
+                                                context=self.rg.evaluation_context(type=type))
+        # Keep the tweets in warm workers for the sweep over D
+        if type == 'calibration':
+            self.executor = simulation.SimulationExecutor(tweets=self.rg.tweets_calibration, zones=self.rg.zones,
+                                                          zone_index=self.rg.zone_index)
+        else:
+            self.executor = simulation.SimulationExecutor(tweets=self.rg.tweets_validation, zones=self.rg.zones,
+                                                          zone_index=self.rg.zone_index)
 
-    def visits_gen_by_days(self, type='calibration', p=None, gamma=None, beta=None, days=None):
+    def kl_by_days(self, type='calibration', p=None, gamma=None, beta=None, days_list=None):
         if type == 'calibration':
             tweets = self.rg.tweets_calibration
         else:
             tweets = self.rg.tweets_validation
-        # userid as index for visits_total
-        visits_total = self.visits.visits_gen(tweets, p, gamma, beta,
-                                              days=days, homelocations=self.rg.home_locations)
-        dms, _, _ = self.visits.visits2measure(visits=visits_total, home_locations=self.rg.home_locations)
-        kl = validation.DistanceMetrics().kullback_leibler(dms, titles=['groundtruth', 'model'])
-        print("D=", days, " kl=", kl)
-        return kl
+        # One simulation up to the largest D, measured at every D on the way
+        measures = self.visits.odm_sweep(tweets, p, gamma, beta, checkpoints=days_list,
+                                         homelocations=self.rg.home_locations, executor=self.executor)
+        list_kl = []
+        for days in days_list:
+            _, kl, _ = measures[days]
+            print("D=", days, " kl=", kl)
+            list_kl.append(kl)
+        return list_kl
 
 
 if __name__ == '__main__':
@@ -75,8 +86,9 @@ if __name__ == '__main__':
         gs = RegionParaGenerate(region=region2compute)
         tp = 'calibration'
         gs.region_data_load(type=tp)
-        list_kl = [gs.visits_gen_by_days(type=tp, p=dc['p'], gamma=dc['gamma'], beta=dc['beta'], days=day) for day in
-                   [1, 5] + [x*10 for x in range(1, 31)]]
+        list_kl = gs.kl_by_days(type=tp, p=dc['p'], gamma=dc['gamma'], beta=dc['beta'],
+                                days_list=[1, 5] + [x*10 for x in range(1, 31)])
+        gs.executor.close()
         df_res = pd.DataFrame()
         df_res.loc[:, 'days'] = [1, 5] + [x*10 for x in range(1, 31)]
         df_res.loc[:, 'kl'] = list_kl
@@ -41,15 +41,14 @@ class RegionParaGenerate:
         # Save gt_odm in dbs for visualization purpose
         gt_path = ROOT_dir + '/dbs/' + self.region + '/odm_gt.csv'
         if ~os.path.exists(gt_path):
-            gt_odm2save = self.rg.gt_odm.copy()
-            gt_odm2save = gt_odm2save.reset_index()
-            gt_odm2save.columns = ['ozone', 'dzone', 'gt']
+            gt_odm2save = self.rg.gt_odm.to_frame('gt')
             print('Saving gt_odm... \n', gt_odm2save.head())
             gt_odm2save.to_csv(gt_path)
         self.visits = gs_model.VisitsGeneration(region=self.region, bbox=self.rg.bbox,
                                                 zones=self.rg.zones, odm=self.rg.gt_odm,
-                                                distances=self.rg.distances,
-                                                distance_quantiles=self.rg.distance_quantiles, gt_dms=self.rg.dms)
+                                                distance_bins=self.rg.distance_bins, gt_dms=self.rg.dms,
+                                                zone_index=self.rg.zone_index,
+                                                context=self.rg.evaluation_context(type=type))
 
     def visits_gen(self, type='calibration', p=None, gamma=None, beta=None):
         if type == 'calibration':
@@ -61,8 +60,7 @@ class RegionParaGenerate:
                                               days=260, homelocations=self.rg.home_locations)
         dms, _, model_odm = self.visits.visits2measure(visits=visits_total, home_locations=self.rg.home_locations)
         # Save model_odm in dbs for visualization purpose
-        model_odm = model_odm.reset_index()
-        model_odm.columns = ['ozone', 'dzone', 'model']
+        model_odm = model_odm.to_frame('model')
         print('Saving model_odm... \n', model_odm.head())
         model_odm.to_csv(ROOT_dir + '/dbs/' + self.region + '/odm_' + type + '.csv')
         dms.to_csv(ROOT_dir + '/results/para-search-r1/' + self.region + '_' + type + '_distances.csv')
@@ -17,6 +17,7 @@ sys.path.insert(0, ROOT_dir + '/lib')
 
 import json
 import lib.gs_model as gs_model
+import lib.simulation as simulation
 import pprint
 import time
 from bayes_opt import BayesianOptimization
@@ -31,6 +32,7 @@ class RegionParaSearch:
         self.region = region
         self.rg = rg
         self.visits = visits
+        self.executor = None
 
     def region_data_load(self):
         self.res = ROOT_dir + '/results/para-search-r1/parasearch-n_' + self.region + '.txt'
@@ -41,16 +43,19 @@ class RegionParaSearch:
         self.rg = rg_
         self.visits = gs_model.VisitsGeneration(region=self.region, bbox=self.rg.bbox,
                                                 zones=self.rg.zones, odm=self.rg.gt_odm,
-                                                distances=self.rg.distances,
-                                                distance_quantiles=self.rg.distance_quantiles, gt_dms=self.rg.dms)
+                                                distance_bins=self.rg.distance_bins, gt_dms=self.rg.dms,
+                                                zone_index=self.rg.zone_index,
+                                                context=self.rg.evaluation_context())
+        # Keep the calibration tweets in warm workers for all evaluations
+        self.executor = simulation.SimulationExecutor(tweets=self.rg.tweets_calibration, zones=self.rg.zones,
+                                                      zone_index=self.rg.zone_index)
 
     def gs_para(self, p=None, gamma=None, beta=None):
-        # userid as index for visits_total
-        visits_total = self.visits.visits_gen(self.rg.tweets_calibration, p, gamma, beta,
-                                              days=140, homelocations=self.rg.home_locations)
-
-        print('Visits generated:', len(visits_total))
-        dms, divergence_measure, _ = self.visits.visits2measure(visits=visits_total, home_locations=self.rg.home_locations)
+        # Only the ODM is needed, so the workers accumulate it directly
+        model_odm = self.visits.odm_gen(self.rg.tweets_calibration, p, gamma, beta,
+                                        days=140, homelocations=self.rg.home_locations,
+                                        executor=self.executor)
+        dms, divergence_measure, _ = self.visits.odm2measure(model_odm)
         # append the result to the parasearch file
         dic = {'region': self.region, 'p': p, 'beta': beta, 'gamma': gamma,
                'kl-baseline': self.rg.kl_baseline, 'kl-deviation': self.rg.kl_deviation,
@@ -87,4 +92,5 @@ if __name__ == '__main__':
             n_iter=50,
         )
         print(optimizer.max)
+        gs.executor.close()
         print(region2search, "is done. Elapsed time was %g seconds" % (time.time() - start_time))